@@ -0,0 +1,33 @@
+"""
+Helpers shared by the bench_* scripts: synthetic candles and timing.
+"""
+from time import perf_counter
+
+import numpy as np
+
+INTERVAL_5M_MS = 5 * 60 * 1000
+NB_CANDLES_YEAR_5M = 365 * 24 * 12  # a year of 5m candles
+
+
+def timed(fn, *args, **kwargs):
+    """(fn(*args, **kwargs), elapsed seconds)"""
+    start = perf_counter()
+    ret = fn(*args, **kwargs)
+    return ret, perf_counter() - start
+
+
+def make_candles(nb_candles, seed=0, volatility=0.0012, buy_probability=0.0):
+    """
+    Random walk of 5m candles starting at 300, as a dict column -> array: 'Open time' / 'Close time' (epoch ms from
+    0), 'Close', 'High' and 'Low' wicking around the open / close, and 'Buy' signals drawn with buy_probability.
+    """
+    rng = np.random.default_rng(seed)
+    close = 300 * np.exp(np.cumsum(rng.normal(0, volatility, nb_candles)))
+    open_ = np.r_[300, close[:-1]]
+    open_times = np.arange(nb_candles, dtype=np.int64) * INTERVAL_5M_MS
+    return {'Open time': open_times,
+            'Close time': open_times + INTERVAL_5M_MS - 1,
+            'Close': close,
+            'High': np.maximum(open_, close) * (1 + np.abs(rng.normal(0, 0.0006, nb_candles))),
+            'Low': np.minimum(open_, close) * (1 - np.abs(rng.normal(0, 0.0006, nb_candles))),
+            'Buy': rng.random(nb_candles) < buy_probability}
@@ -0,0 +1,56 @@
+"""
+Checks batch_final_performance against one simulate_oco_exits + equity_curve run per (tp, sl) pair
+and times both on a year of 5m candles with the gridsearch's tp / sl grid.
+
+    python -m scripts.bench_batch_exits
+"""
+from itertools import product
+
+import numpy as np
+
+from scripts._bench_common import timed, make_candles, NB_CANDLES_YEAR_5M
+from src.utils.trades import simulate_oco_exits, equity_curve, batch_final_performance
+
+INITIAL_INVESTMENT = 100
+TP_THRESHOLDS = [0.0055, 0.0105, 0.02, 0.05]
+SL_RATIOS_TO_TP_THRESHOLDS = [1.5, 2, 3]
+
+
+def close_high_low_buy(nb_candles, buy_probability):
+    candles = make_candles(nb_candles, buy_probability=buy_probability)
+    return candles['Close'], candles['High'], candles['Low'], candles['Buy']
+
+
+def final_performance_per_pair(close, high, low, buy, take_profits, stop_losses):
+    ret = []
+    for take_profit, stop_loss in zip(take_profits, stop_losses):
+        columns, _, _ = simulate_oco_exits(close, high, low, buy, take_profit, stop_loss)
+        performance, _ = equity_curve(close, columns['Buy'], columns['Stop loss'], columns['Take profit'],
+                                      stop_loss=stop_loss, take_profit=take_profit,
+                                      initial_investment=INITIAL_INVESTMENT)
+        ret.append(performance[-1])
+    return np.array(ret)
+
+
+def main():
+    pairs = list(product(TP_THRESHOLDS, SL_RATIOS_TO_TP_THRESHOLDS))
+    take_profits = np.array([tp for tp, _ in pairs])
+    stop_losses = np.array([sl_ratio * tp for tp, sl_ratio in pairs])
+
+    for nb_candles, buy_probability in [(20000, 0.0), (20000, 0.001), (20000, 0.05), (20000, 0.5), (1, 1.0)]:
+        candles = close_high_low_buy(nb_candles, buy_probability)
+        expected = final_performance_per_pair(*candles, take_profits, stop_losses)
+        for max_cells in [50_000_000, 3 * nb_candles]:  # one chunk, chunks of 3 pairs
+            got = batch_final_performance(*candles, take_profits, stop_losses, INITIAL_INVESTMENT, max_cells)
+            assert (expected == got).all(), f'final performance differs (buys {buy_probability}, {max_cells} cells)'
+    print('batched exits identical to one run per pair')
+
+    candles = close_high_low_buy(NB_CANDLES_YEAR_5M, 0.01)
+    _, per_pair_time = timed(final_performance_per_pair, *candles, take_profits, stop_losses)
+    _, batch_time = timed(batch_final_performance, *candles, take_profits, stop_losses, INITIAL_INVESTMENT)
+    print(f'{NB_CANDLES_YEAR_5M} candles x {len(pairs)} pairs: per pair {per_pair_time:.3f}s, batched {batch_time:.3f}s '
+          f'(x{per_pair_time / batch_time:.1f})')
+
+
+if __name__ == "__main__":
+    main()
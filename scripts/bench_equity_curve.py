@@ -0,0 +1,76 @@
+"""
+Checks the array equity curve (equity_curve) against the former iterrows loop of
+Backtester.add_performance_column and times both on a year of 5m candles.
+
+    python -m scripts.bench_equity_curve
+"""
+import numpy as np
+import pandas as pd
+
+from scripts._bench_common import timed, NB_CANDLES_YEAR_5M
+from src.utils.trades import equity_curve
+
+INITIAL_INVESTMENT = 100
+
+
+def performance_rows(df, stop_loss, take_profit, initial_investment=INITIAL_INVESTMENT):
+    # Former implementation, kept as reference
+    portfolio_value = initial_investment
+    in_market = False
+
+    performances_list = []
+
+    for index, row in df.iterrows():
+        if row['Buy'] and not in_market:
+            in_market = True
+            entry_price = row['Close']
+        elif row['Stop loss'] and in_market:
+            in_market = False
+            portfolio_value *= (1 - stop_loss)
+        elif row['Take profit'] and in_market:
+            in_market = False
+            portfolio_value *= (1 + take_profit)
+
+        if in_market:
+            current_value = (portfolio_value * row['Close']) / entry_price
+        else:
+            current_value = portfolio_value
+
+        performances_list.append(current_value)
+
+    return np.array([p / initial_investment for p in performances_list])
+
+
+def make_signals(nb_candles, event_probability, seed=0):
+    # Buy / Stop loss / Take profit drawn independently: overlapping and out-of-position events included
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'Close': 300 * np.exp(np.cumsum(rng.normal(0, 0.0012, nb_candles))),
+                         'Buy': rng.random(nb_candles) < event_probability,
+                         'Stop loss': rng.random(nb_candles) < event_probability,
+                         'Take profit': rng.random(nb_candles) < event_probability})
+
+
+def performance_arrays(df, stop_loss, take_profit, initial_investment=INITIAL_INVESTMENT):
+    return equity_curve(df['Close'].values, df['Buy'].values, df['Stop loss'].values, df['Take profit'].values,
+                        stop_loss=stop_loss, take_profit=take_profit, initial_investment=initial_investment)
+
+
+def main():
+    for event_probability in [0.0, 0.002, 0.05, 0.5]:
+        df = make_signals(20000, event_probability)
+        expected = performance_rows(df, 0.0165, 0.0055)
+        got, stats = performance_arrays(df, 0.0165, 0.0055)
+        assert (expected == got).all(), f'performance differs (events {event_probability})'
+        assert stats['final_return'] == expected[-1] - 1
+        assert stats['max_drawdown'] == np.max(1 - expected / np.maximum.accumulate(expected))
+    print('array equity curve identical to the iterrows loop')
+
+    df = make_signals(NB_CANDLES_YEAR_5M, 0.005)
+    _, rows_time = timed(performance_rows, df, 0.0165, 0.0055)
+    (_, stats), arrays_time = timed(performance_arrays, df, 0.0165, 0.0055)
+    print(f'{NB_CANDLES_YEAR_5M} candles: iterrows {rows_time:.3f}s, arrays {arrays_time:.5f}s '
+          f'(x{rows_time / arrays_time:.0f}) {stats}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Checks the vectorized _add_macd_momentum against the former row-by-row loop and times both
+on a year of 5m candles.
+
+    python -m scripts.bench_macd_momentum
+"""
+import numpy as np
+import pandas as pd
+
+from scripts._bench_common import timed, NB_CANDLES_YEAR_5M
+from src.utils import _add_macd_momentum
+
+PREFIX = '5m'
+
+
+def _add_macd_momentum_loop(df, prefix, consecutive_rows):
+    # Former implementation, kept as reference
+    macd_hist_prev = df[f'{prefix}_MACD_Hist'].shift(1)
+    macd_up_count = 0
+    macd_down_count = 0
+    macd_up = np.zeros(len(df), dtype=bool)
+    macd_down = np.zeros(len(df), dtype=bool)
+
+    for i in range(1, len(df)):
+        if df[f'{prefix}_MACD_Hist'].iloc[i] > macd_hist_prev.iloc[i]:
+            macd_up_count += 1
+            macd_down_count = 0
+        elif df[f'{prefix}_MACD_Hist'].iloc[i] < macd_hist_prev.iloc[i]:
+            macd_down_count += 1
+            macd_up_count = 0
+        else:
+            macd_up_count = 0
+            macd_down_count = 0
+
+        if macd_up_count >= consecutive_rows:
+            macd_up[i] = True
+        if macd_down_count >= consecutive_rows:
+            macd_down[i] = True
+
+    df[f'{prefix}_MACD_UP_Momentum'] = macd_up
+    df[f'{prefix}_MACD_DOWN_Momentum'] = macd_down
+    return df
+
+
+def make_macd_hist(nb_candles, seed=0):
+    rng = np.random.default_rng(seed)
+    hist = np.cumsum(rng.normal(0, 1, nb_candles))
+    hist[:33] = np.nan  # TA-Lib MACD lookback
+    hist[rng.integers(33, nb_candles, nb_candles // 100)] = hist[0]  # a few flat steps and holes
+    return pd.DataFrame({f'{PREFIX}_MACD_Hist': np.round(hist, 1)})
+
+
+def main():
+    df = make_macd_hist(NB_CANDLES_YEAR_5M)
+
+    for consecutive_rows in [0, 1, 2, 3, 5, 8]:
+        expected = _add_macd_momentum_loop(df.copy(), PREFIX, consecutive_rows)
+        got = _add_macd_momentum(df.copy(), PREFIX, consecutive_rows)
+        for column in [f'{PREFIX}_MACD_UP_Momentum', f'{PREFIX}_MACD_DOWN_Momentum']:
+            assert (expected[column].values == got[column].values).all(), f'{column} differs ({consecutive_rows})'
+    print('vectorized momentum identical to the loop')
+
+    _, loop_time = timed(_add_macd_momentum_loop, df.copy(), PREFIX, 3)
+    _, vectorized_time = timed(_add_macd_momentum, df.copy(), PREFIX, 3)
+    print(f'{NB_CANDLES_YEAR_5M} candles: loop {loop_time:.3f}s, vectorized {vectorized_time:.5f}s '
+          f'(x{loop_time / vectorized_time:.0f})')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Checks the streaming IndicatorEngine against TA-Lib batch outputs (add_indicators) and compares the cost of
+one live cycle: a batch recompute over the history vs a constant-time update with the new candle.
+
+    python -m scripts.bench_streaming_indicators
+"""
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+from scripts._bench_common import timed, make_candles
+from src.utils import add_indicators
+from src.utils.streaming_indicators import IndicatorEngine
+
+PREFIX = '5m'
+CONSECUTIVE_HIST = 3
+NB_CANDLES = 30 * 24 * 12  # a month of 5m candles
+TOLERANCE = 1e-9
+
+
+def make_candles_frame(nb_candles):
+    candles = make_candles(nb_candles, volatility=0.002)
+    return pd.DataFrame({'Open time': pd.to_datetime(candles['Open time'], unit='ms'),
+                         'Close': candles['Close'],
+                         'Close time': pd.to_datetime(candles['Close time'], unit='ms')})
+
+
+def check_equivalence(candles):
+    batch = add_indicators(candles.copy(), PREFIX, CONSECUTIVE_HIST)
+
+    # live-like: seeded with the first day, then one new candle per cycle, the last one still open
+    engine = IndicatorEngine(PREFIX, CONSECUTIVE_HIST, history_size=len(candles))
+    for end in list(range(288, len(candles), 37)) + [len(candles)]:
+        window = candles.iloc[:end].copy()
+        now_ms = int(window['Close time'].iloc[-1].value // 10 ** 6)  # last candle still open
+        streamed = engine.add_indicators(window, now_ms)
+
+    for column in engine.columns:
+        expected, got = batch[column].values, streamed[column].values
+        if column.endswith('Momentum'):
+            assert (expected == got).all(), column
+        else:
+            assert (np.isnan(expected) == np.isnan(got)).all(), column
+            assert np.nanmax(np.abs(expected - got)) < TOLERANCE, column
+    print(f'streaming indicators match TA-Lib within {TOLERANCE}')
+
+
+def main():
+    candles = make_candles_frame(NB_CANDLES)
+    check_equivalence(candles)
+
+    _, batch_time = timed(add_indicators, candles.copy(), PREFIX, CONSECUTIVE_HIST)
+
+    nb_updates = 1000
+    closes = candles['Close'].values
+    engine = IndicatorEngine(PREFIX, CONSECUTIVE_HIST)
+    engine.seed(closes[:-nb_updates], range(len(closes) - nb_updates))
+    start = perf_counter()
+    for i in range(len(closes) - nb_updates, len(closes)):
+        engine.update(closes[i], i)
+    update_time = (perf_counter() - start) / nb_updates
+
+    print(f'{NB_CANDLES} candles: batch recompute {batch_time * 1000:.2f}ms, streaming update {update_time * 1e6:.1f}us')
+
+
+if __name__ == "__main__":
+    main()
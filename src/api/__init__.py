@@ -1,13 +1,25 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import hmac
 import hashlib
 from urllib.parse import urlencode
 import pandas as pd
 import logging
 
+from src.api.exceptions import BinanceAPIException
+from src.api.kline_sync import KlineSync
+from src.api.prices import PriceService
+from src.api.rate_limiter import DEFAULT_RATE_LIMITER, endpoint_weight, endpoint_priority
+from src.api.symbol_filters import SymbolFiltersCache, FILTER_ERROR_CODES
+from src.Constants import LOCAL_TZ
 from src.utils import make_df, interval_to_milliseconds, round_to_step_size, round_to_tick_size
+from src.utils.candle_store import CandleStore
+import json
 import time
 import cachetools
 import functools
@@ -40,16 +52,66 @@ def cache_results(func):
 
 ## CACHE SYSTEM ##
 
+
 class BinanceAPIClient:
     # other code ...
     """Client d'API pour Binance"""
 
-    def __init__(self, api_key, api_secret):
+    def __init__(self, api_key, api_secret, pool_size=10, max_retries=3, backoff_factor=0.3, timeout=(3.05, 10),
+                 symbol_filters_ttl=6 * 60 * 60, symbol_filters_cache_path='exchange_info_cache.json',
+                 prices_ttl=2, rate_limiter=None, candle_store=None):
         self.api_key = api_key
         self.api_secret = api_secret
         self.base_url = "https://api.binance.com"
         self.k_lines_limit = 500
 
+        ## <http session> ##
+        self.timeout = timeout  # (connect, read) in seconds
+        self.session = self._make_session(pool_size, max_retries, backoff_factor)
+        # (method, endpoint, status code, elapsed seconds) of the latest requests
+        self.request_timings = deque(maxlen=200)
+        ## </http session> ##
+
+        self.rate_limiter = rate_limiter if rate_limiter is not None else DEFAULT_RATE_LIMITER
+
+        self.symbol_filters = SymbolFiltersCache(self._get_exchange_info,
+                                                 ttl=symbol_filters_ttl,
+                                                 path=symbol_filters_cache_path)
+        self.prices = PriceService(self._get_ticker_prices, ttl=prices_ttl)
+        self.candle_store = candle_store if candle_store is not None else CandleStore()
+        self.kline_sync = KlineSync(self, self.candle_store)
+
+    def _make_session(self, pool_size, max_retries, backoff_factor):
+        # Keep-alive connections shared by every endpoint: one TCP+TLS handshake per pooled connection
+        # instead of one per call. Only idempotent GETs are retried, orders are never replayed.
+        retry = Retry(total=max_retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=[500, 502, 503, 504],
+                      allowed_methods=frozenset(['GET']),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.headers.update({'X-MBX-APIKEY': self.api_key})
+        return session
+
+    def close(self):
+        self.session.close()
+
+    def request_stats(self):
+        """Summary of the latest request timings, to check that connection reuse pays off"""
+        if not self.request_timings:
+            return {'count': 0}
+
+        elapsed = sorted(t[3] for t in self.request_timings)
+        return {'count': len(elapsed),
+                'mean': sum(elapsed) / len(elapsed),
+                'median': elapsed[len(elapsed) // 2],
+                'max': elapsed[-1],
+                # the first request of the window usually pays the handshake
+                'first': self.request_timings[0][3]}
+
     def _generate_signature(self, data):
         query_string = urlencode(data)
         return hmac.new(self.api_secret.encode("utf-8"), query_string.encode("utf-8"), hashlib.sha256).hexdigest()
@@ -59,21 +121,31 @@ class BinanceAPIClient:
         if params is None:
             params = {}
 
+        # Wait for our turn before signing, so the timestamp stays within recvWindow
+        self.rate_limiter.acquire(endpoint_weight(endpoint, params), endpoint_priority(method, endpoint))
+
         if signed:
             params['timestamp'] = int(time.time() * 1000)
             params['recvWindow'] = 5000
             params['signature'] = self._generate_signature(params)
 
-        headers = {
-            'X-MBX-APIKEY': self.api_key
-        }
+        start = time.perf_counter()
+        response = self.session.request(method, url, params=params, timeout=self.timeout)
+        elapsed = time.perf_counter() - start
+        self.request_timings.append((method, endpoint, response.status_code, elapsed))
+        logger.debug(f'{method} {endpoint} {response.status_code} in {elapsed * 1000:.1f}ms')
 
-        response = requests.request(method, url, headers=headers, params=params)
+        weight = response.headers.get('x-mbx-used-weight-1m')
+        if weight is not None:
+            self.rate_limiter.update(int(weight))
+
+        if response.status_code in (429, 418):
+            # 429: too many requests, 418: IP banned after ignoring 429s
+            self.rate_limiter.ban(int(response.headers.get('Retry-After', 60)))
 
         if response.status_code != 200:
-            raise Exception(f'Request failed with status code {response.status_code}: {response.content}')
+            raise BinanceAPIException(response.status_code, response.content)
 
-        weight = response.headers['x-mbx-used-weight-1m']
         if return_weight:
             return response.json(), weight
         return response.json()
@@ -83,19 +155,27 @@ class BinanceAPIClient:
         return self._request("GET", endpoint)
 
     def _get_all_tickers(self):
-        url = f"{self.base_url}/api/v3/ticker/price"
-        return requests.get(url).json()
+        endpoint = "/api/v3/ticker/price"
+        return self._request("GET", endpoint, signed=False)
+
+    def _get_ticker_prices(self, symbols=None):
+        endpoint = "/api/v3/ticker/price"
+        if symbols is None:
+            return self._get_all_tickers()
+        if len(symbols) == 1:
+            return [self._request("GET", endpoint, {'symbol': symbols[0]}, signed=False)]
+        params = {'symbols': json.dumps(list(symbols), separators=(',', ':'))}
+        return self._request("GET", endpoint, params, signed=False)
+
+    def get_price(self, symbol):
+        return self.prices.get_price(symbol)
 
     def _get_current_weight(self):
         url = "/api/v3/ping"
         _, weight = self._request("GET", url, return_weight=True, signed=False)
         return weight
 
-    def get_historical_data(self, symbol: str, interval: str, start_time: datetime,
-                            end_time: datetime = datetime.now()) -> pd.DataFrame:
-        # Convert start_time and end_time to Unix timestamps in milliseconds
-        start_time_ms = int(start_time.timestamp() * 1000)
-        end_time_ms = int(end_time.timestamp() * 1000) if end_time else None
+    def _get_klines(self, symbol: str, interval: str, start_time_ms: int, end_time_ms: int = None) -> list:
         limit = self.k_lines_limit if end_time_ms else 1000
 
         endpoint = "/api/v3/klines"
@@ -108,53 +188,41 @@ class BinanceAPIClient:
             'limit': limit
         }
 
-        data = self._request('GET', endpoint, params, signed=False)
+        return self._request('GET', endpoint, params, signed=False)
+
+    def get_historical_data(self, symbol: str, interval: str, start_time: datetime,
+                            end_time: datetime = datetime.now()) -> pd.DataFrame:
+        # Convert start_time and end_time to Unix timestamps in milliseconds
+        start_time_ms = int(start_time.timestamp() * 1000)
+        end_time_ms = int(end_time.timestamp() * 1000) if end_time else None
+
+        data = self._get_klines(symbol, interval, start_time_ms, end_time_ms)
         return make_df(data)
 
     def print_top_assets(self):
         account_info = self._get_account_info()
         balances = account_info['balances']
-        prices = self._get_all_tickers()
+        prices = self.prices.get_prices()
 
-        # Calculate the total balance in euros
-        total_balance_eur = 0
-        for balance in balances:
-            asset = balance['asset']
-            free = float(balance['free'])
-            locked = float(balance['locked'])
-            balance_eur = 0
-            if asset == 'EUR':
-                balance_eur = free + locked
-            else:
-                for price in prices:
-                    if price['symbol'] == asset + 'EUR':
-                        balance_eur = (free + locked) * float(price['price'])
-                        break
-            total_balance_eur += balance_eur
-
-        # Sort the assets by their euro value
+        # Value every asset in euros
         assets = {}
         for balance in balances:
             asset = balance['asset']
             free = float(balance['free'])
             locked = float(balance['locked'])
-            balance_eur = 0
             if asset == 'EUR':
                 balance_eur = free + locked
             else:
-                for price in prices:
-                    if price['symbol'] == asset + 'EUR':
-                        balance_eur = (free + locked) * float(price['price'])
-                        break
+                balance_eur = (free + locked) * prices.get(asset + 'EUR', 0)
             assets[asset] = balance_eur
 
+        # Sort the assets by their euro value
         top_assets = sorted(assets.items(), key=lambda x: x[1], reverse=True)[:10]
         print(top_assets)
 
     def get_asset_value_in_currency(self, token, currency):
         account_info = self._get_account_info()
         balances = account_info['balances']
-        prices = self._get_all_tickers()
 
         # Find the balance of the specified token
         token_balance = 0
@@ -170,11 +238,11 @@ class BinanceAPIClient:
         token_value_in_currency = 0
         if token == currency:
             token_value_in_currency = token_balance
-        else:
-            for price in prices:
-                if price['symbol'] == token + currency:
-                    token_value_in_currency = token_balance * float(price['price'])
-                    break
+        elif token_balance != 0:
+            try:
+                token_value_in_currency = token_balance * self.get_price(token + currency)
+            except ValueError:
+                pass  # no direct market between token and currency
 
         return token_value_in_currency
 
@@ -199,15 +267,7 @@ class BinanceAPIClient:
             raise ValueError("Either quantity or amount in base symbol must be provided.")
 
         # Get the current token price in the base symbol
-        prices = self._get_all_tickers()
-        token_price_base = None
-        for price in prices:
-            if price['symbol'] == token + base_symbol:
-                token_price_base = float(price['price'])
-                break
-
-        if token_price_base is None:
-            raise ValueError(f"Token price for {token}{base_symbol} not found.")
+        token_price_base = self.get_price(token + base_symbol)
 
         if amount_base is not None:
             # Calculate the quantity to buy/sell using the amount in base symbol
@@ -243,7 +303,7 @@ class BinanceAPIClient:
         params['quantity'] = f"{quantity:.8f}"
 
         # Execute the order
-        response = self._request("POST", endpoint, params)
+        response = self._request_order(endpoint, params)
 
         if response.get("code"):
             raise Exception(f"Error {response['code']}: {response['msg']}")
@@ -301,58 +361,64 @@ class BinanceAPIClient:
         }
 
         # Execute the OCO order
-        response = self._request("POST", endpoint, params)
+        response = self._request_order(endpoint, params)
 
         if response.get("code"):
             raise Exception(f"Error {response['code']}: {response['msg']}")
 
 
 
-    def update_historical_data_csv(self, symbol: str, interval: str, start_time: datetime,
-                                   end_time: datetime = datetime.now(),
-                                   chunk_size: int = 499) -> pd.DataFrame:
-        # Your new function that uses your existing function to get historical data beyond Binance API limitations
-
+    def get_historical_data_range(self, symbol: str, interval: str, start_time: datetime,
+                                  end_time: datetime = None,
+                                  chunk_size: int = 499,
+                                  max_workers: int = 4) -> pd.DataFrame:
+        """
+        Historical data beyond Binance API limitations: the range is split in chunks of `chunk_size` candles,
+        downloaded by `max_workers` threads (the shared rate limiter keeps them within the weight budget),
+        then put back in order and deduplicated on 'Open time'.
+        """
         # Convert the interval string to the number of milliseconds
         ms_interval = interval_to_milliseconds(interval)
 
         # Convert start_time and end_time to Unix timestamps in milliseconds
         start_time_ms = int(start_time.timestamp() * 1000)
-        end_time_ms = int(end_time.timestamp() * 1000)
+        end_time_ms = int((end_time or datetime.now()).timestamp() * 1000)
 
         # Calculate the number of chunks needed to cover the specified time range
-        my_chunks = ((end_time_ms - start_time_ms) // (ms_interval * chunk_size)) + 1
+        # at least one (open-ended) chunk, also for a start_time in the future
+        my_chunks = max(0, (end_time_ms - start_time_ms) // (ms_interval * chunk_size)) + 1
         logger.info(f'Requesting historical data in {my_chunks} chunks')
 
-        # Initialize an empty list to store the results
-        results = []
-
-        # Loop over each chunk and call the get_historical_data function to retrieve data
-        last_loop = False
+        chunks = []
         for i in range(my_chunks):
-            if (i == my_chunks - 1):
-                last_loop = True
-            # Calculate the start and end time for the current chunk
             chunk_start_millis = start_time_ms + i * ms_interval * chunk_size
             chunk_end_millis = min(end_time_ms, chunk_start_millis + ms_interval * chunk_size)
+            # The last chunk is left open-ended to get the candles up to now
+            chunks.append((chunk_start_millis, chunk_end_millis if i < my_chunks - 1 else None))
 
-            chunk_start_time = datetime.utcfromtimestamp(chunk_start_millis / 1000)
-            chunk_end_time = datetime.utcfromtimestamp(chunk_end_millis / 1000) if not (last_loop) else None
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # map keeps the chunks order
+            results = list(executor.map(lambda chunk: make_df(self._get_klines(symbol, interval, *chunk)), chunks))
+        elapsed = time.perf_counter() - start
 
-            # Call the get_historical_data function to retrieve data for the current chunk
-            chunk_data = self.get_historical_data(symbol, interval, chunk_start_time, chunk_end_time)
+        # Concatenate all the results into a big dataframe
+        df = pd.concat(results)
+        df = df.drop_duplicates(subset=['Open time'], keep='last').sort_values('Open time')
 
-            LOCAL_TZ = 'Europe/Paris'
-            chunk_data[f'Open time {LOCAL_TZ}'] = chunk_data['Open time'].dt.tz_localize('UTC').dt.tz_convert(LOCAL_TZ)
-            chunk_data[f'Close time {LOCAL_TZ}'] = chunk_data['Close time'].dt.tz_localize('UTC').dt.tz_convert(
-                LOCAL_TZ)
+        df[f'Open time {LOCAL_TZ}'] = df['Open time'].dt.tz_localize('UTC').dt.tz_convert(LOCAL_TZ)
+        df[f'Close time {LOCAL_TZ}'] = df['Close time'].dt.tz_localize('UTC').dt.tz_convert(LOCAL_TZ)
 
-            # Append the chunk data to the results list
-            results.append(chunk_data)
+        logger.info(f'{len(df)} {symbol} {interval} candles in {elapsed:.2f}s '
+                    f'({len(df) / elapsed if elapsed else 0:.0f} candles/s, {max_workers} workers)')
+        return df
 
-        # Concatenate all the results into a big dataframe
-        df = pd.concat(results)
-        df.drop_duplicates(subset=['Open time'])
+    def update_historical_data_csv(self, symbol: str, interval: str, start_time: datetime,
+                                   end_time: datetime = None,
+                                   chunk_size: int = 499,
+                                   max_workers: int = 4) -> pd.DataFrame:
+        df = self.get_historical_data_range(symbol, interval, start_time, end_time,
+                                            chunk_size=chunk_size, max_workers=max_workers)
 
         csv: str = f'{symbol}_{interval}.csv'  # start_time.strftime("%Y-%m-%d")
         logger.info(f'just updated {csv}')
@@ -361,6 +427,17 @@ class BinanceAPIClient:
 
         return df
 
+    def sync_historical_data(self, symbol: str, interval: str, start_time: datetime, capacity: int = None):
+        """
+        Bring self.candle_store up to date from start_time, downloading only the candles not stored yet.
+        With a capacity, the latest candles are also kept in a ring buffer (see get_live_data_frame).
+        """
+        self.kline_sync.sync(symbol, interval, start_time, capacity=capacity)
+
+    def get_live_data_frame(self, symbol: str, interval: str, start_time: datetime) -> pd.DataFrame:
+        start_time_ms = int(start_time.timestamp() * 1000)
+        return self.kline_sync.ring_buffer(symbol, interval).to_frame(start_ms=start_time_ms)
+
     def get_open_orders(self, token, base_symbol, strategy_name):
         open_orders = self._request("GET", "/api/v3/openOrders", {"symbol": token + base_symbol})
 
@@ -389,26 +466,29 @@ class BinanceAPIClient:
         return historical_orders
 
 
-    def get_symbol_filters(self, symbol):
+    def _get_exchange_info(self):
         endpoint = "/api/v3/exchangeInfo"
         response = self._request("GET", endpoint, signed=False)
 
         if response.get("code"):
             raise Exception(f"Error {response['code']}: {response['msg']}")
 
-        for s in response['symbols']:
-            if s['symbol'] == symbol:
-                filters = {}
-                for f in s['filters']:
-                    if f['filterType'] == 'PRICE_FILTER':
-                        filters['minPrice'] = float(f['minPrice'])
-                        filters['maxPrice'] = float(f['maxPrice'])
-                        filters['tickSize'] = float(f['tickSize'])
-                    elif f['filterType'] == 'LOT_SIZE':
-                        filters['minQty'] = float(f['minQty'])
-                        filters['maxQty'] = float(f['maxQty'])
-                        filters['stepSize'] = float(f['stepSize'])
-
-                return filters
-
-        raise ValueError(f"Symbol {symbol} not found.")
+        for rate_limit in response.get('rateLimits', []):
+            if rate_limit['rateLimitType'] == 'REQUEST_WEIGHT' and rate_limit['interval'] == 'MINUTE' \
+                    and rate_limit['intervalNum'] == 1:
+                self.rate_limiter.configure(rate_limit['limit'])
+
+        return response
+
+    def _request_order(self, endpoint, params):
+        try:
+            return self._request("POST", endpoint, params)
+        except BinanceAPIException as e:
+            if e.code in FILTER_ERROR_CODES:
+                # Filters may have changed on the exchange: next order refetches them
+                logger.warning(f'order rejected by symbol filters ({e.msg}), invalidating exchangeInfo cache')
+                self.symbol_filters.invalidate()
+            raise
+
+    def get_symbol_filters(self, symbol):
+        return self.symbol_filters.get(symbol)
@@ -0,0 +1,15 @@
+import json
+
+# Binance error code returned for an unknown trading pair
+INVALID_SYMBOL_CODE = -1121
+
+
+class BinanceAPIException(Exception):
+    def __init__(self, status_code, content):
+        super().__init__(f'Request failed with status code {status_code}: {content}')
+        self.status_code = status_code
+        try:
+            error = json.loads(content)
+            self.code, self.msg = error.get('code'), error.get('msg')
+        except (ValueError, AttributeError):
+            self.code, self.msg = None, None
@@ -0,0 +1,106 @@
+import logging
+import os
+import threading
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from src.utils import make_df, interval_to_milliseconds
+from src.utils.candle_store import datetime_to_ms
+from src.utils.ring_buffer import OHLCVRingBuffer, VALUE_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+
+class KlineSync:
+    """
+    Local history per (symbol, interval), kept up to date incrementally in a CandleStore.
+
+    When the store does not cover the lookback window yet, the whole window is downloaded once. After that, syncs
+    only ask the exchange for the candles from the last stored one (still open at the previous sync) onwards:
+    that candle is replaced and the new ones are appended to the store.
+
+    When a capacity is given, the latest candles are also kept in a memory-mapped OHLCVRingBuffer, which is what the
+    live strategy reads: its memory use stays bounded however long the process runs.
+    """
+
+    def __init__(self, client, candle_store, klines_per_request=1000):
+        self.client = client
+        self.candle_store = candle_store
+        self.klines_per_request = klines_per_request
+        self._last_open_ms = {}  # (symbol, interval) -> 'Open time' of the last stored candle
+        self._ring_buffers = {}  # (symbol, interval) -> OHLCVRingBuffer
+        self._lock = threading.Lock()
+
+    def sync(self, symbol: str, interval: str, start_time: datetime, capacity: int = None):
+        key = (symbol, interval)
+        start_time_ms = int(start_time.timestamp() * 1000)
+
+        with self._lock:
+            if key not in self._last_open_ms:
+                self._load(symbol, interval, start_time_ms)
+
+            if key not in self._last_open_ms:
+                history = self.client.get_historical_data_range(symbol, interval, start_time)
+                self.candle_store.write(symbol, interval, history)
+                if history.empty:
+                    # new listing or start_time in the future: an empty store, the next sync downloads again
+                    logger.info(f'{symbol} {interval}: no candle since {start_time}')
+                else:
+                    self._last_open_ms[key] = int(history['Open time'].iloc[-1].value // 10 ** 6)
+                    logger.info(f'{symbol} {interval} downloaded: {len(history)} candles')
+                    # a ring made while the store was still empty is refilled below
+                    self._ring_buffers.pop(key, None)
+            else:
+                new_candles = self._fetch_since(symbol, interval, self._last_open_ms[key])
+                if not new_candles.empty:
+                    self.candle_store.append(symbol, interval, new_candles)
+                    self._last_open_ms[key] = int(new_candles['Open time'].iloc[-1].value // 10 ** 6)
+                    logger.info(f'{symbol} {interval} synced: {len(new_candles)} candles updated')
+
+                    if key in self._ring_buffers:
+                        self._push(self._ring_buffers[key], new_candles)
+
+            # one ring per (symbol, interval) at the largest capacity asked for: strategies using the same interval
+            # with different lookbacks share it (to_frame cuts it at their start time) instead of rebuilding it in turn
+            if capacity is not None and (key not in self._ring_buffers or self._ring_buffers[key].capacity < capacity):
+                self._ring_buffers[key] = self._make_ring_buffer(symbol, interval, capacity)
+
+    def ring_buffer(self, symbol, interval) -> OHLCVRingBuffer:
+        return self._ring_buffers[(symbol, interval)]
+
+    def _make_ring_buffer(self, symbol, interval, capacity):
+        # one file per capacity: views handed out by a smaller ring stay valid after it is replaced
+        ring_buffer = OHLCVRingBuffer(os.path.join(self.candle_store.path(symbol, interval), f'ring_{capacity}.bin'),
+                                      capacity)
+        # (re)filled from the store once per process, then only pushed the synced candles
+        ring_buffer.clear()
+        stored = self.candle_store.read(symbol, interval)
+        first = max(0, len(stored['Open time']) - capacity)
+        ring_buffer.extend(stored['Open time'][first:], stored['Close time'][first:],
+                           np.column_stack([stored[column][first:] for column in VALUE_COLUMNS]))
+        return ring_buffer
+
+    @staticmethod
+    def _push(ring_buffer, candles):
+        ring_buffer.extend(datetime_to_ms(candles['Open time']), datetime_to_ms(candles['Close time']),
+                           candles[VALUE_COLUMNS].apply(pd.to_numeric).values)
+
+    def _load(self, symbol, interval, start_time_ms):
+        # Resume from the store if it covers the window: a restart does not download it again
+        stored = self.candle_store.read(symbol, interval, columns=['Open time'])['Open time']
+        if len(stored) and stored[0] - interval_to_milliseconds(interval) <= start_time_ms:
+            self._last_open_ms[(symbol, interval)] = int(stored[-1])
+
+    def _fetch_since(self, symbol, interval, start_time_ms):
+        # usually a single request: only a few candles closed since the previous sync
+        klines = []
+        while True:
+            batch = self.client._get_klines(symbol, interval, start_time_ms)
+            klines.extend(batch)
+            if len(batch) < self.klines_per_request:
+                break
+            start_time_ms = batch[-1][0] + 1
+
+        return make_df(klines)
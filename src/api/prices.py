@@ -0,0 +1,54 @@
+import threading
+import time
+
+from src.api.exceptions import BinanceAPIException, INVALID_SYMBOL_CODE
+
+
+class PriceService:
+    """
+    Ticker prices with a short TTL.
+    A single symbol (or a batch) is fetched on its own instead of downloading every ticker of the exchange;
+    the full symbol -> price snapshot is only built when asked for.
+    """
+
+    def __init__(self, fetch_ticker_prices, ttl=2):
+        self._fetch_ticker_prices = fetch_ticker_prices
+        self.ttl = ttl
+        self._prices = {}  # symbol -> (price, fetched_at)
+        self._snapshot_at = None
+        self._lock = threading.Lock()
+
+    def _is_fresh(self, fetched_at):
+        return fetched_at is not None and (time.time() - fetched_at) < self.ttl
+
+    def _store(self, tickers):
+        now = time.time()
+        for ticker in tickers:
+            self._prices[ticker['symbol']] = (float(ticker['price']), now)
+        return now
+
+    def get_price(self, symbol):
+        return self.get_prices([symbol])[symbol]
+
+    def get_prices(self, symbols=None):
+        """
+        :param symbols: list of symbols, or None for every symbol of the exchange
+        :return: dict symbol -> price
+        """
+        with self._lock:
+            if symbols is None:
+                if not self._is_fresh(self._snapshot_at):
+                    self._snapshot_at = self._store(self._fetch_ticker_prices())
+                return {symbol: price for symbol, (price, fetched_at) in self._prices.items()
+                        if fetched_at >= self._snapshot_at}
+
+            missing = [s for s in symbols if not self._is_fresh(self._prices.get(s, (None, None))[1])]
+            if missing:
+                try:
+                    self._store(self._fetch_ticker_prices(missing))
+                except BinanceAPIException as e:
+                    if e.code == INVALID_SYMBOL_CODE:
+                        raise ValueError(f"Token price for {', '.join(missing)} not found.")
+                    raise
+
+            return {symbol: self._prices[symbol][0] for symbol in symbols}
@@ -0,0 +1,125 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_ORDER = 0  # order placement goes first
+PRIORITY_DATA = 1
+
+ORDER_ENDPOINTS = {'/api/v3/order', '/api/v3/order/oco'}
+
+# Request weights of the endpoints we call (https://binance-docs.github.io/apidocs/spot/en/)
+ENDPOINT_WEIGHTS = {
+    '/api/v3/ping': 1,
+    '/api/v3/account': 20,
+    '/api/v3/exchangeInfo': 20,
+    '/api/v3/openOrders': 6,
+    '/api/v3/allOrders': 20,
+    '/api/v3/order': 1,
+    '/api/v3/order/oco': 1,
+}
+
+
+def endpoint_weight(endpoint, params=None):
+    params = params or {}
+    if endpoint == '/api/v3/klines':
+        limit = params.get('limit') or 500
+        if limit < 100:
+            return 1
+        if limit < 500:
+            return 2
+        if limit <= 1000:
+            return 5
+        return 10
+    if endpoint == '/api/v3/ticker/price':
+        return 2 if 'symbol' in params else 4
+    if endpoint == '/api/v3/openOrders' and 'symbol' not in params:
+        return 80
+    return ENDPOINT_WEIGHTS.get(endpoint, 1)
+
+
+def endpoint_priority(method, endpoint):
+    return PRIORITY_ORDER if method != 'GET' and endpoint in ORDER_ENDPOINTS else PRIORITY_DATA
+
+
+class WeightRateLimiter:
+    """
+    Token bucket on the REQUEST_WEIGHT limit of Binance (per IP, so one instance is shared by every client).
+    The bucket refills continuously at `limit` per `window` seconds and is corrected with the
+    x-mbx-used-weight-1m header of every response. Waiting requests are served by priority, and
+    data requests leave `order_reserve` weight untouched for order placement.
+    """
+
+    def __init__(self, limit=1200, window=60, safety_margin=0.9, order_reserve=20):
+        self.window = window
+        self.safety_margin = safety_margin
+        self.order_reserve = order_reserve
+        self.configure(limit)
+
+        self.tokens = self.capacity
+        self.used_weight = 0  # last value reported by the server
+        self.blocked_until = 0
+        self._last_refill = time.monotonic()
+
+        self._cond = threading.Condition()
+        self._waiting = []  # heap of (priority, sequence)
+        self._sequence = itertools.count()
+
+    def configure(self, limit):
+        self.limit = limit
+        self.capacity = limit * self.safety_margin
+        self.refill_rate = limit / self.window
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._last_refill) * self.refill_rate)
+        self._last_refill = now
+
+    def _wait_time(self, weight, priority):
+        # seconds before a request of this weight and priority may be sent, 0 when it can go now
+        ban = self.blocked_until - time.time()
+        if ban > 0:
+            return ban
+        needed = weight if priority == PRIORITY_ORDER else weight + self.order_reserve
+        missing = min(needed, self.capacity) - self.tokens
+        return max(0, missing / self.refill_rate)
+
+    def acquire(self, weight, priority=PRIORITY_DATA):
+        with self._cond:
+            ticket = (priority, next(self._sequence))
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    self._refill()
+                    wait = self._wait_time(weight, priority) if self._waiting[0] == ticket else None
+                    if wait == 0:
+                        break
+                    if wait is not None and wait > 1:
+                        logger.info(f'rate limiter: waiting {wait:.1f}s for {weight} weight')
+                    self._cond.wait(timeout=wait)
+                self.tokens -= weight
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+    def update(self, used_weight):
+        """Align the bucket on the weight the server says we used in the current minute"""
+        with self._cond:
+            self._refill()
+            self.used_weight = used_weight
+            self.tokens = min(self.tokens, self.capacity - used_weight)
+
+    def ban(self, retry_after):
+        """429/418 received: nothing goes out before `retry_after` seconds"""
+        with self._cond:
+            self.blocked_until = max(self.blocked_until, time.time() + retry_after)
+            self._cond.notify_all()
+        logger.warning(f'rate limit hit, requests paused for {retry_after}s')
+
+
+# Binance limits are per IP: every client of the process shares this limiter by default
+DEFAULT_RATE_LIMITER = WeightRateLimiter()
@@ -0,0 +1,104 @@
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Binance error codes caused by stale or violated symbol filters (step size, tick size, notional...)
+FILTER_ERROR_CODES = {-1013, -1111}
+
+
+def parse_symbol_filters(symbol_info):
+    """Flatten the 'filters' list of one exchangeInfo symbol into a dict"""
+    filters = {'raw': {}}
+    for f in symbol_info['filters']:
+        filter_type = f['filterType']
+        filters['raw'][filter_type] = f
+
+        if filter_type == 'PRICE_FILTER':
+            filters['minPrice'] = float(f['minPrice'])
+            filters['maxPrice'] = float(f['maxPrice'])
+            filters['tickSize'] = float(f['tickSize'])
+        elif filter_type == 'LOT_SIZE':
+            filters['minQty'] = float(f['minQty'])
+            filters['maxQty'] = float(f['maxQty'])
+            filters['stepSize'] = float(f['stepSize'])
+        elif filter_type == 'MARKET_LOT_SIZE':
+            filters['marketMinQty'] = float(f['minQty'])
+            filters['marketMaxQty'] = float(f['maxQty'])
+            filters['marketStepSize'] = float(f['stepSize'])
+        elif filter_type == 'MIN_NOTIONAL':
+            filters['minNotional'] = float(f['minNotional'])
+            filters['applyMinToMarket'] = f.get('applyToMarket', True)
+        elif filter_type == 'NOTIONAL':
+            filters['minNotional'] = float(f['minNotional'])
+            filters['maxNotional'] = float(f['maxNotional'])
+            filters['applyMinToMarket'] = f.get('applyMinToMarket', True)
+
+    return filters
+
+
+class SymbolFiltersCache:
+    """
+    exchangeInfo loaded once, indexed by symbol and refreshed after `ttl` seconds.
+    When `path` is given, the index is persisted so a restart does not refetch it.
+    """
+
+    def __init__(self, fetch_exchange_info, ttl=6 * 60 * 60, path=None):
+        self._fetch_exchange_info = fetch_exchange_info
+        self.ttl = ttl
+        self.path = path
+        self._filters = {}
+        self._fetched_at = None
+        self._lock = threading.Lock()
+
+        if self.path is not None:
+            self._load()
+
+    def _is_fresh(self):
+        return self._fetched_at is not None and (time.time() - self._fetched_at) < self.ttl
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                cached = json.load(f)
+            self._filters = cached['symbols']
+            self._fetched_at = cached['fetched_at']
+        except (ValueError, KeyError) as e:
+            logger.warning(f'ignoring unreadable symbol filters cache {self.path}: {e}')
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'fetched_at': self._fetched_at, 'symbols': self._filters}, f)
+        os.replace(tmp_path, self.path)
+
+    def refresh(self):
+        exchange_info = self._fetch_exchange_info()
+        self._filters = {s['symbol']: parse_symbol_filters(s) for s in exchange_info['symbols']}
+        self._fetched_at = time.time()
+        logger.info(f'exchangeInfo loaded: {len(self._filters)} symbols')
+
+        if self.path is not None:
+            self._save()
+
+    def invalidate(self):
+        """Refetch on the next get, in this process and after a restart (persisted index marked stale)"""
+        with self._lock:
+            self._fetched_at = None
+            if self.path is not None and os.path.isfile(self.path):
+                self._save()
+
+    def get(self, symbol):
+        with self._lock:
+            if not self._is_fresh():
+                self.refresh()
+
+            try:
+                return self._filters[symbol]
+            except KeyError:
+                raise ValueError(f"Symbol {symbol} not found.")
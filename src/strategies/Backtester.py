@@ -2,17 +2,23 @@ from typing import List
 from src.strategies import BaseStrategyThread
 from src.strategies.MarketBuyOcoSellAtClose import CallStrategyAtClose
 import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
 
-from src.utils import plot_close_price_with_signals
+from src.utils import plot_close_price_with_signals, close_times_ms
+from src.utils.trades import equity_curve, StreamingEquityCurve, simulate_oco_exits, trade_segments
 
 
 class Backtester():
-    def __init__(self, strategies: List[BaseStrategyThread], plot = True):
+    def __init__(self, strategies: List[BaseStrategyThread], plot = True, dump = True):
         self.client = None  # shouldnt have to use this for backstest. Local data only
         self.strategies_list: List[BaseStrategyThread] = strategies
         self.plot = plot
+        self.dump = dump  # False in gridsearch workers: the dumps of every combination would land in the same file
 
         self.dct_of_df_with_buy_sl_tp_columns = {s.name: None for s in self.strategies_list}
+        # filled along the Performance column: final_return, max_drawdown, trades, win_rate
+        self.dct_of_summary_stats = {s.name: None for s in self.strategies_list}
 
     def run(self):
 
@@ -22,7 +28,9 @@ class Backtester():
             self.dct_of_df_with_buy_sl_tp_columns.update({strategy.name: df_with_buy_sl_tp_columns})
             self.add_performance_column(strategy_name)
 
-            self.dct_of_df_with_buy_sl_tp_columns[strategy_name].to_csv(f"backtest_{strategy_name}_{strategy.symbol}")
+            if self.dump:
+                # binary dump: no csv formatting cost, dtypes kept for later analysis (pd.read_pickle)
+                self.dct_of_df_with_buy_sl_tp_columns[strategy_name].to_pickle(f"backtest_{strategy_name}_{strategy.symbol}.pkl")
 
             if self.plot:
                 plot_close_price_with_signals(df_with_buy_sl_tp_columns)
@@ -42,34 +50,21 @@ class Backtester():
         df = self.dct_of_df_with_buy_sl_tp_columns[strategy_name]
         initial_investment, stop_loss, take_profit = self._strategies_attributes(strategy_name)
 
-        portfolio_value = initial_investment
-        in_market = False
+        performance, summary_stats = equity_curve(df['Close'].values,
+                                                  df['Buy'].values,
+                                                  df['Stop loss'].values,
+                                                  df['Take profit'].values,
+                                                  stop_loss=stop_loss,
+                                                  take_profit=take_profit,
+                                                  initial_investment=initial_investment)
 
-        performances_list = []
-
-        for index, row in df.iterrows():
-            if row['Buy'] and not in_market:
-                in_market = True
-                entry_price = row['Close']
-            elif row['Stop loss'] and in_market:
-                in_market = False
-                exit_price = row['Close']
-                portfolio_value *= (1 - stop_loss)
-            elif row['Take profit'] and in_market:
-                in_market = False
-                exit_price = row['Close']
-                portfolio_value *= (1 + take_profit)
-
-            if in_market:
-                current_value = (portfolio_value * row['Close']) / entry_price
-            else:
-                current_value = portfolio_value
-
-            performances_list.append(current_value)
-
-        df['Performance'] = [p / initial_investment for p in performances_list]
+        df['Performance'] = performance
+        self.dct_of_summary_stats[strategy_name] = summary_stats
         return df  # With perf col added
 
+    def summary_stats(self):
+        return dict(self.dct_of_summary_stats)  # {"s2": {"final_return": -0.22, "max_drawdown": 0.31, ...}}
+
     def plot_performance(self, strategy_name):
         df = self.dct_of_df_with_buy_sl_tp_columns[strategy_name]
         plt.figure(figsize=(12, 6))
@@ -83,12 +78,208 @@ class Backtester():
         ret = {strategy_name: None for strategy_name in self.dct_of_df_with_buy_sl_tp_columns.keys()}
 
         for strategy_name, df in self.dct_of_df_with_buy_sl_tp_columns.items():
-            df_with_perf = self.add_performance_column(strategy_name)
-            last_perf_value = df_with_perf['Performance'].iloc[-1]
+            if 'Performance' not in df.columns:
+                df = self.add_performance_column(strategy_name)
+            last_perf_value = df['Performance'].iloc[-1]
             ret.update({strategy_name: last_perf_value})
 
         return ret  # {"s2": "0.78", "s1": "1.12"}
 
+
+class StreamingBacktester():
+    """
+    Backtester for histories too long to hold in memory: each strategy runs block by block of `block_size` short
+    interval candles (CallStrategyAtClose.iter_backtest_blocks), its Performance column carried from block to block.
+    Blocks are handed to on_block(strategy_name, df) as they come and then dropped, so that peak memory depends on
+    block_size and not on the length of the history.
+    """
+
+    def __init__(self, strategies: List[CallStrategyAtClose], block_size=100_000, on_block=None):
+        self.strategies_list = strategies
+        self.block_size = block_size
+        self.on_block = on_block
+
+        self.dct_of_equity_curves = {s.name: None for s in self.strategies_list}
+
+    def run(self):
+        for strategy in self.strategies_list:
+            curve = StreamingEquityCurve(stop_loss=strategy.stop_loss_threshold,
+                                         take_profit=strategy.take_profit_threshold,
+                                         initial_investment=strategy.initial_investment_in_base_symbol_quantity)
+            self.dct_of_equity_curves[strategy.name] = curve
+
+            for df in strategy.iter_backtest_blocks(self.block_size):
+                df['Performance'] = curve.update(df['Close'].values, df['Buy'].values, df['Stop loss'].values,
+                                                 df['Take profit'].values)
+                if self.on_block is not None:
+                    self.on_block(strategy.name, df)
+
+        return self.latest_perf_values()
+
+    def summary_stats(self):
+        return {name: curve.stats() for name, curve in self.dct_of_equity_curves.items()}
+
+    def latest_perf_values(self):
+        return {name: curve.last_performance for name, curve in self.dct_of_equity_curves.items()}
+
+
+class PortfolioBacktester():
+    """
+    Strategies (any symbols) trading one shared capital, in one pass over the candles of each symbol:
+
+    - candles, indicators and signals are built once per (symbol, interval) and per indicator / signal parameters
+      (StagedBacktests), and aligned once per (symbol, intervals): strategies differing only in their buy condition,
+      take profit or stop loss share all of it
+    - each strategy then only runs its buy condition and its stop loss / take profit exits (simulate_oco_exits) on
+      those shared arrays, which gives its trades as in Backtester (entry on a Buy when out of the market, exit on
+      the next stop loss / take profit row)
+    - the entries and exits of all strategies are replayed in time order on their merged timeline to decide which
+      trades the portfolio can take. An entry commits `position_size` of the portfolio value (cash + open positions
+      at their last Close), capped by the cash left; it is rejected when no cash is left or `max_positions`
+      positions are open. Exits come before entries at the same time, and pay back the committed amount times
+      (1 + tp) or (1 - sl)
+    """
+
+    def __init__(self, strategies: List[CallStrategyAtClose], initial_capital=1000, position_size=None,
+                 max_positions=None):
+        if not strategies:
+            raise ValueError('PortfolioBacktester needs at least one strategy')
+        self.strategies_list = strategies
+        self.initial_capital = float(initial_capital)
+        self.position_size = position_size if position_size is not None else 1 / len(strategies)
+        self.max_positions = max_positions
+
+        self.df_performance = None  # Close time, Cash, Positions value, Performance on the merged timeline
+        self.df_trades = None  # one row per trade of every strategy, taken or rejected
+
+    def _strategies_trades(self):
+        # Gridsearch imports this module
+        from src.strategies.Gridsearch import StagedBacktests
+
+        # large enough for every frame of the strategies: none is built twice
+        staged_backtests = StagedBacktests(maxsize=3 * len(self.strategies_list))
+        aggregated_dfs = {}  # (symbol, intervals, indicators and signals parameters) -> aligned signals
+        legs = []
+        for strategy in self.strategies_list:
+            intervals = (strategy.short_interval, strategy.medium_interval, strategy.long_interval)
+            key = (strategy.symbol, intervals, strategy.consecutive_hist_before_momentum, strategy.rsi_oversold,
+                   strategy.rsi_overbought)
+            if key not in aggregated_dfs:
+                aggregated_dfs[key] = strategy._add_local_times(strategy.aggregate_time_frames_signals(
+                    *(staged_backtests._signals_frame(strategy, interval) for interval in intervals)))
+            legs.append(self._strategy_trades(strategy, aggregated_dfs[key]))
+        return legs
+
+    @staticmethod
+    def _strategy_trades(strategy, aggregated_df):
+        # the exits of strategy.apply_strategy, without adding its columns to the shared frame
+        close, high, low = (aggregated_df[column].values.astype(np.float64) for column in ['Close', 'High', 'Low'])
+        intrabar = None
+        if strategy.intrabar_interval is not None and len(aggregated_df):
+            intrabar = strategy._intrabar_candles(aggregated_df)
+        buy = np.asarray(strategy.buy_condition(aggregated_df), dtype=bool)
+        columns, _, _ = simulate_oco_exits(close, high, low, buy, take_profit=strategy.take_profit_threshold,
+                                           stop_loss=strategy.stop_loss_threshold, intrabar=intrabar)
+        entries, exits = trade_segments(columns['Buy'], columns['Stop loss'] | columns['Take profit'])
+        factors = np.where(columns['Stop loss'][exits], 1 - strategy.stop_loss_threshold,
+                           1 + strategy.take_profit_threshold)
+        return close_times_ms(aggregated_df), close, entries, exits, factors
+
+    def run(self):
+        legs = self._strategies_trades()
+        timeline = np.unique(np.concatenate([close_times for close_times, *_ in legs]))
+        # row of the last Close of each strategy at every step of the timeline, -1 before its first one
+        rows = [np.searchsorted(close_times, timeline, side='right') - 1 for close_times, *_ in legs]
+
+        # entries and exits of every strategy as timeline steps, in time order, exits first
+        events = []
+        for i, (close_times, _, entries, exits, _) in enumerate(legs):
+            entry_steps = np.searchsorted(timeline, close_times[entries])
+            exit_steps = np.searchsorted(timeline, close_times[exits])
+            for trade, (entry_step, exit_, exit_step) in enumerate(zip(entry_steps, exits, exit_steps)):
+                events.append((entry_step, 1, i, trade))
+                if exit_ >= 0:
+                    events.append((exit_step, 0, i, trade))
+        events.sort()
+
+        # Close of every strategy at the steps where the portfolio is valued: the entries
+        valued_steps = np.unique([step for step, is_entry, _, _ in events if is_entry])
+        closes_at_entries = np.array([close[np.maximum(strategy_rows[valued_steps], 0)]
+                                      for (_, close, *_), strategy_rows in zip(legs, rows)])
+
+        cash = self.initial_capital
+        units = np.zeros(len(legs))  # held by each strategy: one open trade at most
+        open_positions = {}  # (strategy index, trade) -> committed amount
+        trades = {}
+        for step, is_entry, i, trade in events:
+            close_times, close, entries, exits, factors = legs[i]
+            if not is_entry:
+                if (i, trade) in open_positions:
+                    cash += open_positions.pop((i, trade)) * factors[trade]
+                    units[i] = 0.0
+                continue
+
+            positions_value = units @ closes_at_entries[:, np.searchsorted(valued_steps, step)]
+            committed = min(cash, self.position_size * (cash + positions_value))
+            taken = committed > 0 and (self.max_positions is None or len(open_positions) < self.max_positions)
+            if taken:
+                cash -= committed
+                open_positions[(i, trade)] = committed
+                units[i] = committed / close[entries[trade]]
+            trades[(i, trade)] = committed if taken else 0.0
+
+        self.df_performance = self._performance(legs, trades, timeline, rows)
+        self.df_trades = self._trades_frame(legs, trades)
+        return self.df_performance['Performance'].iloc[-1]
+
+    def _performance(self, legs, trades, timeline, rows):
+        cash_changes = np.zeros(len(timeline))
+        positions_value = np.zeros(len(timeline))
+        for i, ((close_times, close, entries, exits, factors), strategy_rows) in enumerate(zip(legs, rows)):
+            units_changes = np.zeros(len(timeline) + 1)
+            for trade, (entry, exit_) in enumerate(zip(entries, exits)):
+                committed = trades[(i, trade)]
+                if not committed:
+                    continue
+                entry_step = np.searchsorted(timeline, close_times[entry])
+                exit_step = np.searchsorted(timeline, close_times[exit_]) if exit_ >= 0 else len(timeline)
+                cash_changes[entry_step] -= committed
+                units_changes[entry_step] += committed / close[entry]
+                units_changes[exit_step] -= committed / close[entry]
+                if exit_ >= 0:
+                    cash_changes[exit_step] += committed * factors[trade]
+
+            units = np.cumsum(units_changes[:-1])
+            positions_value += np.where(units > 0, units * close[np.maximum(strategy_rows, 0)], 0.0)
+
+        cash = self.initial_capital + np.cumsum(cash_changes)
+        return pd.DataFrame({'Close time': pd.to_datetime(timeline, unit='ms'),
+                             'Cash': cash,
+                             'Positions value': positions_value,
+                             'Performance': (cash + positions_value) / self.initial_capital})
+
+    def _trades_frame(self, legs, trades):
+        rows = []
+        for i, (strategy, (close_times, _, entries, exits, factors)) in enumerate(zip(self.strategies_list, legs)):
+            for trade, (entry, exit_) in enumerate(zip(entries, exits)):
+                rows.append({'strategy': strategy.name,
+                             'symbol': strategy.symbol,
+                             'entry time': pd.to_datetime(close_times[entry], unit='ms'),
+                             'exit time': pd.to_datetime(close_times[exit_], unit='ms') if exit_ >= 0 else pd.NaT,
+                             'factor': factors[trade] if exit_ >= 0 else np.nan,
+                             'committed': trades[(i, trade)]})
+        return pd.DataFrame(rows, columns=['strategy', 'symbol', 'entry time', 'exit time', 'factor', 'committed'])
+
+    def summary_stats(self):
+        performance = self.df_performance['Performance'].values
+        taken = self.df_trades[(self.df_trades['committed'] > 0) & self.df_trades['exit time'].notna()]
+        return {'final_return': float(performance[-1] - 1),
+                'max_drawdown': float(np.max(1 - performance / np.maximum.accumulate(performance))),
+                'trades': len(taken),
+                'win_rate': float((taken['factor'] > 1).mean()) if len(taken) else float('nan'),
+                'rejected': int((self.df_trades['committed'] == 0).sum())}
+
+
 def main():
     client = None
 
@@ -112,6 +303,7 @@ def main():
 
     latest_perf_values = backtester.run()  # {"s2": "0.78", "s1": "1.12"}
     print(f'last_perfs_values : {latest_perf_values}')
+    print(f'summary stats : {backtester.summary_stats()}')
 
 if __name__ == "__main__":
     main()
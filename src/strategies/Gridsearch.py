@@ -1,68 +1,425 @@
+import logging
+import os
+import random
+from collections import Counter
+from itertools import product
+from multiprocessing import Pool
+
+import cachetools
+import numpy as np
+import pandas as pd
 from tqdm import tqdm
-import pickle
 
 from src.strategies.Backtester import Backtester
 from src.strategies.MarketBuyOcoSellAtClose import CallStrategyAtClose
+from src.utils import close_times_ms
+from src.utils.candle_store import CandleStore
+from src.utils.indicator_cache import DEFAULT_INDICATOR_CACHE
+from src.utils.result_store import GridsearchResultStore, params_hash
+from src.utils.shared_candles import SharedCandleStore
+from src.utils.trades import batch_final_performance
+
+logger = logging.getLogger(__name__)
+
+INITIAL_INVESTMENT = 100
+CACHE_COUNTERS = ('memory_hits', 'disk_hits', 'misses')
+
+_worker_candle_store = None  # SharedCandleStore attached by each process of the parallel gridsearch
+_worker_staged_backtests = None  # StagedBacktests of each process of the parallel gridsearch
+
+
+def _combinations(symbols, long_intervals, medium_intervals, short_intervals, tp_thresholds,
+                  sl_ratio_to_tp_thresholds, rsi_oversolds, consecutive_hists):
+    # same order as the former nested loops, symbols innermost
+    for long_interval, medium_interval, short_interval, tp_threshold, sl_ratio_to_tp_threshold, rsi_oversold, \
+            consecutive_hist, symbol_tuple in product(long_intervals, medium_intervals, short_intervals, tp_thresholds,
+                                                      sl_ratio_to_tp_thresholds, rsi_oversolds, consecutive_hists,
+                                                      symbols):
+        params = {
+            'symbol': symbol_tuple[0] + symbol_tuple[1],
+            'long_interval': long_interval,
+            'medium_interval': medium_interval,
+            'short_interval': short_interval,
+            'tp_threshold': tp_threshold,
+            'sl_ratio_to_tp_threshold': sl_ratio_to_tp_threshold,
+            'rsi_oversold': rsi_oversold,
+            'consecutive_hist_before_momentum': consecutive_hist,
+        }
+        yield symbol_tuple, params
+
+
+def _backtest(exchange_client, symbol_tuple, params, candle_store=None, dump=True):
+    strategy = CallStrategyAtClose(
+        name="s",
+        initial_investment_in_base_symbol_quantity=INITIAL_INVESTMENT,
+        exchange_client=exchange_client,
+        symbol=params['symbol'],
+        token=symbol_tuple[0],
+        base_symbol=symbol_tuple[1],
+        long_interval=params['long_interval'],
+        medium_interval=params['medium_interval'],
+        short_interval=params['short_interval'],
+        tp_threshold=params['tp_threshold'],
+        sl_ratio_to_tp_threshold=params['sl_ratio_to_tp_threshold'],
+        mode="backtest",
+        rsi_oversold=params['rsi_oversold'],
+        consecutive_hist_before_momentum=params['consecutive_hist_before_momentum'],
+        candle_store=candle_store,
+    )
+    backtester = Backtester([strategy], plot=False, dump=dump)
+    latest_perf_values = backtester.run()
+    score = latest_perf_values["s"]
+    return {'score': score, 'params': params}
+
+
+class StagedBacktests:
+    """
+    The backtests of a gridsearch as a DAG of stages. Each stage only depends on a subset of the parameters, so its
+    output is computed once per distinct subset and reused by every downstream combination:
+
+        candles     (symbol, interval)
+        indicators  (symbol, interval, consecutive_hist)
+        signals     (symbol, interval, consecutive_hist, rsi_oversold, rsi_overbought)
+        entries     (symbol, long / medium / short intervals, consecutive_hist, rsi_oversold): aligned buy signals
+        exits       (entries, tp_threshold, sl_ratio_to_tp_threshold): every pair at once, batch_final_performance
+
+    Every stage runs the code of CallStrategyAtClose, so scores are those of a full Backtester run. The stages outputs
+    are kept in LRUs of `maxsize` frames: `groups` orders the entries so that their inputs are still cached.
+    """
+
+    def __init__(self, candle_store=None, maxsize=16):
+        self.candle_store = candle_store if candle_store is not None else CandleStore()
+        self._candles = cachetools.LRUCache(maxsize=maxsize)
+        self._indicators = cachetools.LRUCache(maxsize=maxsize)
+        self._signals = cachetools.LRUCache(maxsize=maxsize)
+
+    @staticmethod
+    def groups(symbols, long_intervals, medium_intervals, short_intervals, consecutive_hists, rsi_oversolds):
+        # upstream parameters outermost: consecutive runs of groups share their indicators and signals
+        for symbol_tuple, consecutive_hist, rsi_oversold, long_interval, medium_interval, short_interval in \
+                product(symbols, consecutive_hists, rsi_oversolds, long_intervals, medium_intervals, short_intervals):
+            yield symbol_tuple, long_interval, medium_interval, short_interval, consecutive_hist, rsi_oversold
+
+    def _signals_frame(self, strategy, interval):
+        candles_key = (strategy.symbol, interval)
+        if candles_key not in self._candles:
+            self._candles[candles_key] = strategy._read_raw_data_frame(interval)
+
+        indicators_key = candles_key + (strategy.consecutive_hist_before_momentum,)
+        if indicators_key not in self._indicators:
+            # add_indicators adds its columns to the frame it is given: the cached candles stay raw
+            self._indicators[indicators_key] = strategy.add_indicators_to_data_frame(
+                self._candles[candles_key].copy(), interval)
+
+        signals_key = indicators_key + (strategy.rsi_oversold, strategy.rsi_overbought)
+        if signals_key not in self._signals:
+            self._signals[signals_key] = strategy.add_signals_to_data_frame(self._indicators[indicators_key], interval)
+        return self._signals[signals_key]
+
+    def run_group(self, symbol_tuple, long_interval, medium_interval, short_interval, consecutive_hist, rsi_oversold,
+                  exits, window=1.0, periods=None):
+        """
+        Scores of the combinations sharing these upstream parameters
+        :param exits: [(tp_threshold, sl_ratio_to_tp_threshold), ...]
+        :param window: fraction of the most recent candles the trades are simulated on, starting out of position
+        :param periods: [(start_ms, end_ms), ...] of Close times, each also scored on its own (starting out of
+        position) in the 'period_scores' of the results
+        :return: [{'score': ..., 'params': ...}, ...] in the order of exits
+        """
+        strategy = CallStrategyAtClose(name="s",
+                                       initial_investment_in_base_symbol_quantity=INITIAL_INVESTMENT,
+                                       exchange_client=None,
+                                       symbol=symbol_tuple[0] + symbol_tuple[1],
+                                       token=symbol_tuple[0],
+                                       base_symbol=symbol_tuple[1],
+                                       long_interval=long_interval,
+                                       medium_interval=medium_interval,
+                                       short_interval=short_interval,
+                                       mode="backtest",
+                                       rsi_oversold=rsi_oversold,
+                                       consecutive_hist_before_momentum=consecutive_hist,
+                                       candle_store=self.candle_store)
+
+        # entries
+        aggregated_df = strategy.aggregate_time_frames_signals(self._signals_frame(strategy, short_interval),
+                                                               self._signals_frame(strategy, medium_interval),
+                                                               self._signals_frame(strategy, long_interval))
+        buy = np.asarray(strategy.buy_condition(aggregated_df), dtype=bool)
+        close, high, low = (aggregated_df[column].values for column in ['Close', 'High', 'Low'])
+
+        # exits: every (tp, sl) pair at once, same thresholds as CallStrategyAtClose and same performance as Backtester
+        tp_thresholds = np.array([tp_threshold for tp_threshold, _ in exits])
+        stop_loss_thresholds = np.array([sl_ratio_to_tp_threshold * tp_threshold
+                                         for tp_threshold, sl_ratio_to_tp_threshold in exits])
+
+        def scores_of(rows):
+            return batch_final_performance(close[rows], high[rows], low[rows], buy[rows], tp_thresholds,
+                                           stop_loss_thresholds, initial_investment=INITIAL_INVESTMENT)
+
+        scores = scores_of(slice(len(close) - max(1, int(np.ceil(window * len(close)))), len(close)))
+        if periods is not None:
+            close_times = close_times_ms(aggregated_df)
+            period_scores = [scores_of(slice(*np.searchsorted(close_times, period))) for period in periods]
+
+        results = []
+        for i, ((tp_threshold, sl_ratio_to_tp_threshold), score) in enumerate(zip(exits, scores)):
+            params = {
+                'symbol': strategy.symbol,
+                'long_interval': long_interval,
+                'medium_interval': medium_interval,
+                'short_interval': short_interval,
+                'tp_threshold': tp_threshold,
+                'sl_ratio_to_tp_threshold': sl_ratio_to_tp_threshold,
+                'rsi_oversold': rsi_oversold,
+                'consecutive_hist_before_momentum': consecutive_hist,
+            }
+            results.append({'score': score, 'params': params})
+            if periods is not None:
+                results[-1]['period_scores'] = [float(period[i]) for period in period_scores]
+        return results
+
+
+def _indicator_cache_counts():
+    stats = DEFAULT_INDICATOR_CACHE.stats()
+    return Counter({counter: stats[counter] for counter in CACHE_COUNTERS})
+
+
+def _init_worker(candles_descriptor):
+    global _worker_candle_store, _worker_staged_backtests
+    _worker_candle_store = SharedCandleStore.attach(candles_descriptor)
+    _worker_staged_backtests = StagedBacktests(_worker_candle_store)
+
+
+# the workers return their indicators cache counts with their results: each process has its own cache
+
+
+def _backtest_in_worker(combination):
+    symbol_tuple, params = combination
+    before = _indicator_cache_counts()
+    result = _backtest(None, symbol_tuple, params, candle_store=_worker_candle_store, dump=False)
+    return result, _indicator_cache_counts() - before
+
+
+def _run_group_in_worker(job):
+    group, exits, window, periods = job
+    before = _indicator_cache_counts()
+    group_results = _worker_staged_backtests.run_group(*group, exits, window, periods)
+    return group_results, _indicator_cache_counts() - before
 
 
 def gridsearch(exchange_client, symbols, long_intervals, medium_intervals, short_intervals, tp_thresholds,
-               sl_ratio_to_tp_thresholds, rsi_oversolds, consecutive_hists):
+               sl_ratio_to_tp_thresholds, rsi_oversolds, consecutive_hists, processes=1, staged=True,
+               result_store: GridsearchResultStore = None):
+    """
+    Backtests every combination of parameters: [{'score': last performance value, 'params': {...}}, ...]
+
+    :param processes: number of worker processes, None for one per core. With more than one, the candles of every
+    (symbol, interval) are loaded once into shared memory and the backtests (which never use exchange_client) run in
+    a process pool.
+    :param staged: run the combinations through StagedBacktests, where indicators, signals and entries are computed
+    once per distinct upstream parameters. Otherwise every combination is a full Backtester run.
+    :param result_store: results are written to it as they come, and the combinations it already holds are not
+    backtested again: an interrupted gridsearch resumes where it stopped.
+    """
+    grid = (symbols, long_intervals, medium_intervals, short_intervals, tp_thresholds, sl_ratio_to_tp_thresholds,
+            rsi_oversolds, consecutive_hists)
+    combinations = list(_combinations(*grid))
+    results = result_store.get([params for _, params in combinations]) if result_store is not None else {}
+    pending = [(symbol_tuple, params) for symbol_tuple, params in combinations if params_hash(params) not in results]
+    processes = processes or os.cpu_count()
+
+    mode = ', '.join([*(['staged'] if staged else []), *([f'{processes} processes'] if processes > 1 else [])])
+    cache_counts_before = _indicator_cache_counts()
+    with tqdm(total=len(combinations), initial=len(combinations) - len(pending),
+              desc=f"Grid Search Progress{f' ({mode})' if mode else ''}") as pbar:
+        def collect(new_results):
+            if result_store is not None:
+                result_store.add(new_results)
+            results.update({params_hash(result['params']): result for result in new_results})
+            pbar.update(len(new_results))
+
+        worker_cache_counts = Counter()
+        if staged:
+            worker_cache_counts = _staged_gridsearch(grid, pending, processes, collect)
+        elif processes == 1:
+            for symbol_tuple, params in pending:
+                collect([_backtest(exchange_client, symbol_tuple, params)])
+        else:
+            worker_cache_counts = _parallel_gridsearch(grid, pending, processes, collect)
+
+    # indicators only depend on (symbol, interval, consecutive_hist): most combinations are cache hits
+    cache_counts = _indicator_cache_counts() - cache_counts_before + worker_cache_counts
+    logger.info('indicators cache: ' + ', '.join(f'{counter} {cache_counts[counter]}' for counter in CACHE_COUNTERS))
+
+    return [results[params_hash(params)] for _, params in combinations]
+
+
+def _import_candles(grid):
+    symbols, long_intervals, medium_intervals, short_intervals = grid[:4]
+    candle_store = CandleStore()
+    keys = sorted({(token + base_symbol, interval) for token, base_symbol in symbols
+                   for interval in {*long_intervals, *medium_intervals, *short_intervals}})
+    for symbol, interval in keys:
+        candle_store.import_csv_if_newer(symbol, interval, f'{symbol}_{interval}.csv')
+    return candle_store, keys
+
+
+def _publish_candles(grid):
+    return SharedCandleStore.publish(*_import_candles(grid))
+
+
+def _parallel_gridsearch(grid, combinations, processes, collect):
+    """:return: the indicators cache counts of the workers"""
+    cache_counts = Counter()
+    shared_candles = _publish_candles(grid)
+    try:
+        with Pool(processes, initializer=_init_worker, initargs=(shared_candles.descriptor(),)) as pool:
+            for result, worker_cache_counts in pool.imap_unordered(_backtest_in_worker, combinations):
+                collect([result])
+                cache_counts += worker_cache_counts
+    finally:
+        shared_candles.unlink()
+    return cache_counts
+
+
+def _staged_gridsearch(grid, combinations, processes, collect, window=1.0, periods=None):
+    """:return: the indicators cache counts of the workers, empty when run in this process"""
+    symbols, long_intervals, medium_intervals, short_intervals, _, _, rsi_oversolds, consecutive_hists = grid
+    # exits still to run of each group, groups in StagedBacktests.groups order
+    exits = {}
+    for symbol_tuple, params in combinations:
+        group = (symbol_tuple, params['long_interval'], params['medium_interval'], params['short_interval'],
+                 params['consecutive_hist_before_momentum'], params['rsi_oversold'])
+        exits.setdefault(group, []).append((params['tp_threshold'], params['sl_ratio_to_tp_threshold']))
+    groups = StagedBacktests.groups(symbols, long_intervals, medium_intervals, short_intervals, consecutive_hists,
+                                    rsi_oversolds)
+    jobs = [(group, exits[group], window, periods) for group in groups if group in exits]
+    cache_counts = Counter()
+    if not jobs:
+        return cache_counts
+
+    if processes == 1:
+        staged_backtests = StagedBacktests()
+        for group, group_exits, window, periods in jobs:
+            collect(staged_backtests.run_group(*group, group_exits, window, periods))
+        return cache_counts
+
+    shared_candles = _publish_candles(grid)
+    try:
+        with Pool(processes, initializer=_init_worker, initargs=(shared_candles.descriptor(),)) as pool:
+            # chunks of consecutive groups: each worker gets runs of groups sharing their indicators and signals
+            chunksize = max(1, len(jobs) // (4 * processes))
+            for group_results, worker_cache_counts in pool.imap_unordered(_run_group_in_worker, jobs,
+                                                                          chunksize=chunksize):
+                collect(group_results)
+                cache_counts += worker_cache_counts
+    finally:
+        shared_candles.unlink()
+    return cache_counts
+
+
+def successive_halving(symbols, long_intervals, medium_intervals, short_intervals, tp_thresholds,
+                       sl_ratio_to_tp_thresholds, rsi_oversolds, consecutive_hists, n_candidates=81, eta=3,
+                       min_window=1 / 9, processes=1, seed=0):
+    """
+    Adaptive alternative to gridsearch over the same parameters and scores, for grids too large to backtest
+    exhaustively. n_candidates combinations are sampled from the grid and backtested on the most recent min_window
+    fraction of the candles; the best 1 / eta of them are backtested again on a window eta times longer, and so on
+    until the full history. With the defaults: 81 candidates on 1/9 of the candles, 27 on 1/3, 9 on all of them, the
+    cost of 27 full backtests.
+
+    :return: the candidates of the last (full history) round, best first, as [{'score': ..., 'params': ...}, ...]
+    """
+    if not eta > 1:
+        raise ValueError(f'eta must be greater than 1, got {eta}')
+    if not 0 < min_window <= 1:
+        raise ValueError(f'min_window must be in ]0, 1], got {min_window}')
+
+    grid = (symbols, long_intervals, medium_intervals, short_intervals, tp_thresholds, sl_ratio_to_tp_thresholds,
+            rsi_oversolds, consecutive_hists)
+    combinations = list(_combinations(*grid))
+    candidates = random.Random(seed).sample(combinations, min(n_candidates, len(combinations)))
+    processes = processes or os.cpu_count()
+
+    windows = [min_window]
+    while windows[-1] < 1:
+        windows.append(min(1.0, windows[-1] * eta))
+    windows[-1] = 1.0
+
+    for rung, window in enumerate(windows):
+        results = []
+        with tqdm(total=len(candidates), desc=f"Successive Halving ({len(candidates)} on {window:.0%} of candles)") \
+                as pbar:
+            def collect(new_results):
+                results.extend(new_results)
+                pbar.update(len(new_results))
+
+            _staged_gridsearch(grid, candidates, processes, collect, window)
+
+        results.sort(key=lambda result: result['score'], reverse=True)
+        if rung == len(windows) - 1:
+            return results
+        kept = {params_hash(result['params']) for result in results[:max(1, len(results) // eta)]}
+        candidates = [(symbol_tuple, params) for symbol_tuple, params in candidates if params_hash(params) in kept]
+
+
+def walk_forward(symbols, long_intervals, medium_intervals, short_intervals, tp_thresholds,
+                 sl_ratio_to_tp_thresholds, rsi_oversolds, consecutive_hists, train_days=180, test_days=30,
+                 processes=1):
+    """
+    Walk-forward validation of the gridsearch. The history common to every (symbol, interval) is split in rolling
+    folds of train_days followed by test_days, moving by test_days. On each fold the combination with the best score
+    on the train period is picked, then scored on the test period it was not picked on.
+
+    Every combination is backtested once through StagedBacktests, the trades of each train and test period being
+    simulated on the same indicators and entries (starting out of position at the beginning of the period).
+
+    :return: one dict per fold: {'train': (start, end), 'test': (start, end), 'params': {...}, 'train_score': ...,
+    'test_score': ...}, periods as naive UTC Timestamps
+    """
+    grid = (symbols, long_intervals, medium_intervals, short_intervals, tp_thresholds, sl_ratio_to_tp_thresholds,
+            rsi_oversolds, consecutive_hists)
+    candle_store, keys = _import_candles(grid)
+    close_times = [candle_store.read(symbol, interval, columns=['Close time'])['Close time']
+                   for symbol, interval in keys]
+    start = max(times[0] for times in close_times)
+    end = min(times[-1] for times in close_times) + 1
+
+    day_ms = 24 * 60 * 60 * 1000
+    folds = []
+    train_start = start
+    while train_start + (train_days + test_days) * day_ms <= end:
+        train_end = train_start + train_days * day_ms
+        folds.append(((train_start, train_end), (train_end, train_end + test_days * day_ms)))
+        train_start += test_days * day_ms
+    if not folds:
+        raise ValueError(f'{train_days} + {test_days} days do not fit in the {(end - start) / day_ms:.0f} days of '
+                         f'candles common to {keys}')
+
+    combinations = list(_combinations(*grid))
     results = []
+    with tqdm(total=len(combinations), desc=f"Walk Forward ({len(folds)} folds)") as pbar:
+        def collect(new_results):
+            results.extend(new_results)
+            pbar.update(len(new_results))
+
+        _staged_gridsearch(grid, combinations, processes or os.cpu_count(), collect,
+                           periods=[period for fold in folds for period in fold])
+
+    ret = []
+    for i, (train, test) in enumerate(folds):
+        best = max(results, key=lambda result: result['period_scores'][2 * i])
+        ret.append({'train': tuple(pd.to_datetime(train, unit='ms')),
+                    'test': tuple(pd.to_datetime(test, unit='ms')),
+                    'params': best['params'], 'train_score': best['period_scores'][2 * i],
+                    'test_score': best['period_scores'][2 * i + 1]})
+    return ret
+
 
-    total_iterations = (len(long_intervals) * len(medium_intervals) * len(short_intervals) *
-                        len(tp_thresholds) * len(sl_ratio_to_tp_thresholds) * len(rsi_oversolds) * len(
-                consecutive_hists) * len(symbols))
-
-    with tqdm(total=total_iterations, desc="Grid Search Progress") as pbar:
-        for long_interval in long_intervals:
-            for medium_interval in medium_intervals:
-                for short_interval in short_intervals:
-                    for tp_threshold in tp_thresholds:
-                        for sl_ratio_to_tp_threshold in sl_ratio_to_tp_thresholds:
-                            for rsi_oversold in rsi_oversolds:
-                                for consecutive_hist in consecutive_hists:
-                                    for symbol_tuple in symbols:
-                                        strategy = CallStrategyAtClose(
-                                            name="s",
-                                            initial_investment_in_base_symbol_quantity=100,
-                                            exchange_client=exchange_client,
-                                            symbol=symbol_tuple[0] + symbol_tuple[1],
-                                            token=symbol_tuple[0],
-                                            base_symbol=symbol_tuple[1],
-                                            long_interval=long_interval,
-                                            medium_interval=medium_interval,
-                                            short_interval=short_interval,
-                                            tp_threshold=tp_threshold,
-                                            sl_ratio_to_tp_threshold=sl_ratio_to_tp_threshold,
-                                            mode="backtest",
-                                            rsi_oversold=rsi_oversold,
-                                            consecutive_hist_before_momentum=consecutive_hist,
-                                        )
-                                        backtester = Backtester([strategy], plot=False)
-                                        latest_perf_values = backtester.run()
-                                        score = latest_perf_values["s"]
-
-                                        params = {
-                                            'symbol': symbol_tuple[0] + symbol_tuple[1],
-                                            'long_interval': long_interval,
-                                            'medium_interval': medium_interval,
-                                            'short_interval': short_interval,
-                                            'tp_threshold': tp_threshold,
-                                            'sl_ratio_to_tp_threshold': sl_ratio_to_tp_threshold,
-                                            'rsi_oversold': rsi_oversold,
-                                            'consecutive_hist_before_momentum': consecutive_hist,
-                                        }
-
-                                        results.append({'score': score, 'params': params})
-                                        pbar.update(1)
-
-    return results
-
-
-def print_cached_results():
-    with open('sorted_results.pkl', 'rb') as f:
-        sorted_results = pickle.load(f)
-    print(sorted_results[0:20])
+def print_cached_results(path='gridsearch_results.sqlite'):
+    result_store = GridsearchResultStore(path)
+    print(result_store.top(20))
+    result_store.close()
 
 
 if __name__ == "__main__":
@@ -85,9 +442,9 @@ if __name__ == "__main__":
         sl_ratio_to_tp_thresholds=[1.5, 2,3],
         rsi_oversolds=[20, 30, 40,50],
         consecutive_hists=[2, 3, 5, 8],
+        processes=None,
+        result_store=GridsearchResultStore(),
     )
 
     sorted_results = sorted(results, key=lambda x: x['score'], reverse=True)
     print(sorted_results)
-    with open('sorted_results.pkl', 'wb') as f:
-        pickle.dump(sorted_results, f)
@@ -1,6 +1,7 @@
 import os
 from datetime import datetime, timedelta
 
+import numpy as np
 import pandas as pd
 import pytz as pytz
 import time
@@ -9,7 +10,14 @@ from src.Constants import LOCAL_TZ, PRINTED_DATE_FORMAT
 from src.api import BinanceAPIClient
 from src.strategies import BaseStrategyThread
 from src.utils import add_indicators, add_indicators_signals, \
-    short_term_df_with_other_time_frames_signals, SIGNAL_PREFIX, interval_to_minutes, nb_days_YTD, validate_oco_prices
+    short_term_df_with_other_time_frames_signals, SIGNAL_PREFIX, interval_to_minutes, nb_days_YTD, \
+    validate_oco_prices, close_times_ms, as_datetime
+from src.utils.alignment_cache import AlignmentIndexCache, DEFAULT_ALIGNMENT_CACHE
+from src.utils.candle_store import CandleStore, datetime_to_ms
+from src.utils.indicator_cache import IndicatorCache, DEFAULT_INDICATOR_CACHE
+from src.utils.resampler import CandleResampler
+from src.utils.streaming_indicators import IndicatorEngine
+from src.utils.trades import simulate_oco_exits, intrabar_rows
 
 KNOWN_MODES = ["backtest", "live"]
 
@@ -29,7 +37,12 @@ class CallStrategyAtClose(BaseStrategyThread):
                  mode="backtest",
                  rsi_oversold=50,
                  rsi_overbought=60,
-                 consecutive_hist_before_momentum=3):
+                 consecutive_hist_before_momentum=3,
+                 candle_store: CandleStore = None,
+                 indicator_cache: IndicatorCache = DEFAULT_INDICATOR_CACHE,
+                 alignment_cache: AlignmentIndexCache = DEFAULT_ALIGNMENT_CACHE,
+                 base_interval: str = None,
+                 intrabar_interval: str = None):
         super().__init__(name=name, exchange_client=exchange_client, mode=mode)
         assert mode in KNOWN_MODES, f'strategy mode must be one of {KNOWN_MODES}'
         assert (token + base_symbol) == symbol, "wtf are you doing ?"
@@ -45,6 +58,10 @@ class CallStrategyAtClose(BaseStrategyThread):
         self.last_buy_price = None
         self.order_ids = self._load_order_ids_from_cache()
 
+        if candle_store is None:
+            candle_store = exchange_client.candle_store if exchange_client is not None else CandleStore()
+        self.candle_store = candle_store
+
         ## <multi frame> ##
         self.long_interval = long_interval
         self.live_long_interval_nb_days_lookup = nb_days_YTD()
@@ -54,6 +71,14 @@ class CallStrategyAtClose(BaseStrategyThread):
 
         self.short_interval = short_interval
         self.live_short_interval_nb_days_lookup = 0.5
+
+        # when set (e.g. '1m' or the short interval), only this interval is downloaded and stored: the three time
+        # frames are resampled from it locally
+        self.base_interval = base_interval
+        self.resampler = CandleResampler(self.candle_store) if base_interval is not None else None
+        # backtest mode: finer candles (e.g. '1m') telling whether the stop loss or the take profit came first in the
+        # short interval bars reaching both
+        self.intrabar_interval = intrabar_interval
         ## <multi frame> ##
 
         ## Tuning Params
@@ -62,6 +87,12 @@ class CallStrategyAtClose(BaseStrategyThread):
         self.consecutive_hist_before_momentum = consecutive_hist_before_momentum
         ##
 
+        # live mode: indicators updated candle by candle instead of recomputed over the whole history
+        self.indicator_engines = {}  # interval -> IndicatorEngine
+        # backtest mode: indicators shared by the strategies running on the same candles (None to always compute)
+        self.indicator_cache = indicator_cache
+        self.alignment_cache = alignment_cache
+
     def is_in_position(self):
         open_orders = self.exchange_client.get_open_orders(self.token, self.base_symbol, self.strategy_name)
         for order in open_orders:
@@ -82,73 +113,123 @@ class CallStrategyAtClose(BaseStrategyThread):
         except FileNotFoundError:
             return []
 
-    def update_historical_data_csv(self):
-        if self.mode == "live":
-            start_long = datetime.now() - timedelta(days=self.live_long_interval_nb_days_lookup)
-            start_medium = datetime.now() - timedelta(days=self.live_medium_interval_nb_days_lookup)
-            start_short = datetime.now() - timedelta(days=self.live_short_interval_nb_days_lookup)
-            self.exchange_client.update_historical_data_csv(self.symbol, self.long_interval,
-                                                            start_long)
-            self.exchange_client.update_historical_data_csv(self.symbol, self.medium_interval,
-                                                            start_medium)
-            self.exchange_client.update_historical_data_csv(self.symbol, self.short_interval,
-                                                            start_short)
+    def live_start_times(self):
+        now = datetime.now()
+        return {self.long_interval: now - timedelta(days=self.live_long_interval_nb_days_lookup),
+                self.medium_interval: now - timedelta(days=self.live_medium_interval_nb_days_lookup),
+                self.short_interval: now - timedelta(days=self.live_short_interval_nb_days_lookup)}
+
+    def live_capacity(self, interval):
+        # candles kept in memory for an interval: its lookback window (a full year for the YTD long one)
+        nb_days = {self.long_interval: 366,
+                   self.medium_interval: self.live_medium_interval_nb_days_lookup,
+                   self.short_interval: self.live_short_interval_nb_days_lookup}[interval]
+        return int(nb_days * 24 * 60 // interval_to_minutes(interval)) + 2
+
+    def update_historical_data(self):
+        if self.mode == "live" and self.base_interval is not None:
+            # a single feed, covering the longest lookback window
+            self.exchange_client.sync_historical_data(self.symbol, self.base_interval,
+                                                      min(self.live_start_times().values()))
+        elif self.mode == "live":
+            for interval, start_time in self.live_start_times().items():
+                self.exchange_client.sync_historical_data(self.symbol, interval, start_time,
+                                                          capacity=self.live_capacity(interval))
         elif self.mode == "backtest":
-            self.logger.info("using cached csv")
+            self.logger.info("using cached candles")
+
+    def _import_csv_if_newer(self, interval):
+        if self.mode == "backtest":
+            # csv downloaded with BinanceAPIClient.update_historical_data_csv: converted once
+            self.candle_store.import_csv_if_newer(self.symbol, interval, f'{self.symbol}_{interval}.csv')
+
+    def _stored_interval(self, interval):
+        """Interval of the candle store holding the candles of interval, imported or resampled first"""
+        if self.base_interval is not None:
+            self._import_csv_if_newer(self.base_interval)
+            return self.resampler.update(self.symbol, self.base_interval, interval)
+
+        self._import_csv_if_newer(interval)
+        return interval
+
+    def _read_raw_data_frame(self, interval, start_time=None):
+        start_ms = int(start_time.timestamp() * 1000) if start_time is not None else None
+
+        if self.mode == "live" and self.base_interval is None:
+            return self.exchange_client.get_live_data_frame(self.symbol, interval, start_time)
+
+        return self.candle_store.read_frame(self.symbol, self._stored_interval(interval), start_ms=start_ms)
 
     def read_raw_data_frames(self):
-        df_short_raw = pd.read_csv(f'{self.symbol}_{self.short_interval}.csv')
-        df_medium_raw = pd.read_csv(f'{self.symbol}_{self.medium_interval}.csv')
-        df_long_raw = pd.read_csv(f'{self.symbol}_{self.long_interval}.csv')
-
-        # df_short_raw['Open time'] = pd.to_datetime(df_short_raw['Open time'].tz_localize(LOCAL_TZ))
-        # df_short_raw['Close time'] = pd.to_datetime(df_short_raw['Close time'].tz_localize(LOCAL_TZ))
-        #
-        # df_medium_raw['Open time'] = pd.to_datetime(df_medium_raw['Open time'].tz_localize(LOCAL_TZ))
-        # df_medium_raw['Close time'] = pd.to_datetime(df_medium_raw['Close time'].tz_localize(LOCAL_TZ))
-        #
-        # df_long_raw['Open time'] = pd.to_datetime(df_long_raw['Open time'].tz_localize(LOCAL_TZ))
-        # df_long_raw['Close time'] = pd.to_datetime(df_long_raw['Close time'].tz_localize(LOCAL_TZ))
+        start_times = self.live_start_times() if self.mode == "live" else {}
+
+        df_short_raw = self._read_raw_data_frame(self.short_interval, start_times.get(self.short_interval))
+        df_medium_raw = self._read_raw_data_frame(self.medium_interval, start_times.get(self.medium_interval))
+        df_long_raw = self._read_raw_data_frame(self.long_interval, start_times.get(self.long_interval))
 
         return df_short_raw, df_medium_raw, df_long_raw
 
-    def add_indicators_to_data_frames(self, df_short_raw, df_medium_raw, df_long_raw):
-        df_short = add_indicators(df_short_raw,
-                                  prefix=self.short_interval,
-                                  consecutive_hist_before_momentum=self.consecutive_hist_before_momentum)
+    def _add_streaming_indicators(self, df_raw, interval):
+        if interval not in self.indicator_engines:
+            # seeded with the first frame, then only fed the candles closed since the previous cycle
+            self.indicator_engines[interval] = IndicatorEngine(prefix=interval,
+                                                               consecutive_hist_before_momentum=self.consecutive_hist_before_momentum,
+                                                               history_size=self.live_capacity(interval))
+        now_ms = int(time.time() * 1000)
+        return self.indicator_engines[interval].add_indicators(df_raw, now_ms)
+
+    def add_indicators_to_data_frame(self, df_raw, interval):
+        compute = self.indicator_cache.add_indicators if self.indicator_cache is not None else add_indicators
+        return compute(df_raw, prefix=interval, consecutive_hist_before_momentum=self.consecutive_hist_before_momentum)
 
-        df_medium = add_indicators(df_medium_raw,
-                                   prefix=self.medium_interval,
-                                   consecutive_hist_before_momentum=self.consecutive_hist_before_momentum)
+    def add_indicators_to_data_frames(self, df_short_raw, df_medium_raw, df_long_raw):
+        if self.mode == "live":
+            return self._add_streaming_indicators(df_short_raw, self.short_interval), \
+                self._add_streaming_indicators(df_medium_raw, self.medium_interval), \
+                self._add_streaming_indicators(df_long_raw, self.long_interval)
 
-        df_long = add_indicators(df_long_raw,
-                                 prefix=self.long_interval,
-                                 consecutive_hist_before_momentum=self.consecutive_hist_before_momentum)
+        df_short = self.add_indicators_to_data_frame(df_short_raw, self.short_interval)
+        df_medium = self.add_indicators_to_data_frame(df_medium_raw, self.medium_interval)
+        df_long = self.add_indicators_to_data_frame(df_long_raw, self.long_interval)
 
         return df_short, df_medium, df_long
 
+    def add_signals_to_data_frame(self, df, interval):
+        return add_indicators_signals(df,
+                                      prefix=interval,
+                                      rsi_oversold=self.rsi_oversold,
+                                      rsi_overbought=self.rsi_overbought)
+
     def add_signals_to_data_frames(self, df_short, df_medium, df_long):
-        short_df_with_signals = add_indicators_signals(df_short,
-                                                       prefix=self.short_interval,
-                                                       rsi_oversold=self.rsi_oversold,
-                                                       rsi_overbought=self.rsi_overbought)
+        short_df_with_signals = self.add_signals_to_data_frame(df_short, self.short_interval)
+        medium_df_with_signals = self.add_signals_to_data_frame(df_medium, self.medium_interval)
+        long_df_with_signals = self.add_signals_to_data_frame(df_long, self.long_interval)
 
-        medium_df_with_signals = add_indicators_signals(df_medium,
-                                                        prefix=self.medium_interval,
-                                                        rsi_oversold=self.rsi_oversold,
-                                                        rsi_overbought=self.rsi_overbought)
+        return short_df_with_signals, medium_df_with_signals, long_df_with_signals
 
-        long_df_with_signals = add_indicators_signals(df_long,
-                                                      prefix=self.long_interval,
-                                                      rsi_oversold=self.rsi_oversold,
-                                                      rsi_overbought=self.rsi_overbought)
+    def aggregate_time_frames_signals(self, short_df_with_signals, medium_df_with_signals, long_df_with_signals,
+                                      cache_alignment=True):
+        alignment_indexes = None
+        if self.mode == "backtest" and self.alignment_cache is not None and cache_alignment:
+            # live frames move every cycle: only backtests reuse the row mappings
+            alignment_indexes = self.alignment_cache.get(self.symbol,
+                                                         (self.short_interval, self.medium_interval, self.long_interval),
+                                                         short_df_with_signals, medium_df_with_signals,
+                                                         long_df_with_signals)
 
-        return short_df_with_signals, medium_df_with_signals, long_df_with_signals
+        aggregated_df = short_term_df_with_other_time_frames_signals(short_df_with_signals,
+                                                                     medium_df_with_signals,
+                                                                     long_df_with_signals,
+                                                                     alignment_indexes=alignment_indexes)
+
+        signals_columns = [col for col in aggregated_df.columns if SIGNAL_PREFIX in col]
+        aggregated_df.loc[:, signals_columns] = aggregated_df.loc[:, signals_columns].fillna(False)
+        return aggregated_df
 
     def get_short_df_with_higher_tf_signals(self):
         assert self.mode in ['backtest', 'live']
 
-        self.update_historical_data_csv()
+        self.update_historical_data()
 
         df_short_raw, df_medium_raw, df_long_raw = self.read_raw_data_frames()
 
@@ -159,15 +240,14 @@ class CallStrategyAtClose(BaseStrategyThread):
         short_df_with_signals, medium_df_with_signals, long_df_with_signals = self.add_signals_to_data_frames(
             df_short, df_medium, df_long)
 
-        aggregated_df = short_term_df_with_other_time_frames_signals(short_df_with_signals,
-                                                                     medium_df_with_signals,
-                                                                     long_df_with_signals)
-
-        signals_columns = [col for col in aggregated_df.columns if SIGNAL_PREFIX in col]
-        aggregated_df.loc[:, signals_columns] = aggregated_df.loc[:, signals_columns].fillna(False)
+        aggregated_df = self.aggregate_time_frames_signals(short_df_with_signals, medium_df_with_signals,
+                                                           long_df_with_signals)
+        return self._add_local_times(aggregated_df)
 
-        aggregated_df['Open time'] = pd.to_datetime(aggregated_df['Open time'])
-        aggregated_df['Close time'] = pd.to_datetime(aggregated_df['Close time'])
+    @staticmethod
+    def _add_local_times(aggregated_df):
+        aggregated_df['Open time'] = as_datetime(aggregated_df['Open time'])
+        aggregated_df['Close time'] = as_datetime(aggregated_df['Close time'])
 
         aggregated_df[f'Open time {LOCAL_TZ}'] = aggregated_df['Open time'].dt.tz_localize('UTC').dt.tz_convert(
             LOCAL_TZ)
@@ -175,40 +255,79 @@ class CallStrategyAtClose(BaseStrategyThread):
             LOCAL_TZ)
         return aggregated_df
 
+    def _block_signals_frame(self, stored_interval, interval, first, last, warmup):
+        """Indicators and signals of the stored candles [first, last), computed from `warmup` candles earlier"""
+        open_times = self.candle_store.read(self.symbol, stored_interval, columns=['Open time'])['Open time']
+        start = max(0, first - warmup)
+        df = self.candle_store.read_frame(self.symbol, stored_interval, start_ms=int(open_times[start]),
+                                          end_ms=int(open_times[last]) if last < len(open_times) else None)
+        # not through the indicator cache: blocks are never shared between backtests
+        df = add_indicators(df, prefix=interval, consecutive_hist_before_momentum=self.consecutive_hist_before_momentum)
+        return self.add_signals_to_data_frame(df.iloc[first - start:].reset_index(drop=True), interval)
+
+    def iter_backtest_blocks(self, block_size=100_000, warmup=1000):
+        """
+        Backtest of the stored candles for histories too long to hold in memory: yields the frames of
+        get_df_with_buy_sl_tp_columns block after block of `block_size` short interval candles.
+
+        The indicators of a block are computed from the `warmup` candles before it, where the seeds of TA-Lib's EMAs
+        and RSI have long faded out; the position state is carried from block to block by apply_strategy.
+        """
+        assert self.mode == "backtest", "only backtests run block by block"
+        higher_intervals = [self.medium_interval, self.long_interval]
+        stored = {interval: self._stored_interval(interval) for interval in [self.short_interval, *higher_intervals]}
+        close_times = {interval: self.candle_store.read(self.symbol, stored_interval,
+                                                        columns=['Close time'])['Close time']
+                       for interval, stored_interval in stored.items()}
+        next_rows = [0] * len(higher_intervals)
+        self.in_position, self.last_buy_price = False, None
+
+        short_close_times = close_times[self.short_interval]
+        for first in range(0, len(short_close_times), block_size):
+            last = min(first + block_size, len(short_close_times))
+            short_df = self._block_signals_frame(stored[self.short_interval], self.short_interval, first, last, warmup)
+
+            higher_dfs = []
+            for i, interval in enumerate(higher_intervals):
+                higher_last = int(np.searchsorted(close_times[interval], short_close_times[last - 1], side='right'))
+                # the last higher candle of the previous block can still be the one of the first short candles
+                higher_first = max(0, next_rows[i] - 1)
+                higher_dfs.append(self._block_signals_frame(stored[interval], interval, higher_first, higher_last,
+                                                            warmup))
+                next_rows[i] = higher_last
+
+            aggregated_df = self.aggregate_time_frames_signals(short_df, *higher_dfs, cache_alignment=False)
+            yield self.apply_strategy(self._add_local_times(aggregated_df))
+
     def apply_strategy(self, df_with_indicators: pd.DataFrame):
-        df_with_indicators['Buy'] = False
-        df_with_indicators['Stop loss'] = False
-        df_with_indicators['Take profit'] = False
-        df_with_indicators['In position'] = False
-
-        def process_row(row):
-            just_bought = False
-            nonlocal self
-            # Buy
-            if self.buy_condition(row):
-                row['Buy'] = True
-                if not(self.in_position):
-                    just_bought = True
-                self.in_position = True
-                self.last_buy_price = row['Close']
-
-            elif self.in_position:
-                # Stop loss
-                if row['Low'] <= self.last_buy_price * (1 - self.stop_loss_threshold):
-                    row['Stop loss'] = True
-                    self.in_position = False
-
-                # Take profit
-                elif row['High'] >= self.last_buy_price * (1 + self.take_profit_threshold):
-                    row['Take profit'] = True
-                    self.in_position = False
-
-            row['In position'] = False if just_bought else self.in_position
-            return row
-
-        df_with_indicators = df_with_indicators.apply(process_row, axis=1)
+        # buy_condition is element-wise: evaluated on the whole frame, then the position state machine runs on arrays
+        buy = self.buy_condition(df_with_indicators)
+        intrabar = None
+        if self.intrabar_interval is not None and self.mode == "backtest" and len(df_with_indicators):
+            intrabar = self._intrabar_candles(df_with_indicators)
+        columns, self.in_position, self.last_buy_price = simulate_oco_exits(df_with_indicators['Close'].values,
+                                                                            df_with_indicators['High'].values,
+                                                                            df_with_indicators['Low'].values,
+                                                                            np.asarray(buy, dtype=bool),
+                                                                            take_profit=self.take_profit_threshold,
+                                                                            stop_loss=self.stop_loss_threshold,
+                                                                            in_position=self.in_position,
+                                                                            last_buy_price=self.last_buy_price,
+                                                                            intrabar=intrabar)
+        for column, values in columns.items():
+            df_with_indicators[column] = values
         return df_with_indicators
 
+    def _intrabar_candles(self, df):
+        """(first, last, High, Low) of the intrabar_interval candles inside each row of df, for simulate_oco_exits"""
+        self._import_csv_if_newer(self.intrabar_interval)
+        open_times, close_times = datetime_to_ms(df['Open time']), close_times_ms(df)
+        # memory-mapped: only the pages of the bars looked into are read
+        fine = self.candle_store.read(self.symbol, self.intrabar_interval, start_ms=open_times[0],
+                                      end_ms=close_times[-1] + 1, columns=['Open time', 'High', 'Low'])
+        first, last = intrabar_rows(open_times, close_times, fine['Open time'])
+        return first, last, fine['High'], fine['Low']
+
     def buy_condition(self, row):
         # long_term_cond = row[f'{self.long_interval}_ema_short_above_long_{SIGNAL_PREFIX}']
         # medium_term_cond = row[f'{self.medium_interval}_momentum_up_{SIGNAL_PREFIX}']
@@ -254,7 +373,7 @@ class CallStrategyAtClose(BaseStrategyThread):
                 if df_with_buy_sl_tp_columns.iloc[-1]['Buy']:
                     self.logger.info("Got buy signal. Let's go !")
                     self.buy()
-        self.logger.info(f'x-mbx-used-weight-1m: {self.exchange_client._get_current_weight()}')
+        self.logger.info(f'x-mbx-used-weight-1m: {self.exchange_client.rate_limiter.used_weight}')
 
     def schedule_trading_strategy(self):
         assert self.short_interval[-1] == 'm', "short interval must be minute"
@@ -288,12 +407,7 @@ class CallStrategyAtClose(BaseStrategyThread):
 
     def buy(self):
         # Get the current token price in the base symbol
-        prices = self.exchange_client._get_all_tickers()
-        token_price_base = None
-        for price in prices:
-            if price['symbol'] == self.token + self.base_symbol:
-                token_price_base = float(price['price'])
-                break
+        token_price_base = self.exchange_client.get_price(self.symbol)
 
         # Define the prices & quantity for the OCO order
         ## <oco>
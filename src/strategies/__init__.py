@@ -1,3 +1,4 @@
+import os
 import threading
 import time
 import logging
@@ -21,13 +22,16 @@ class BaseStrategyThread(threading.Thread):
         max_file_size = 3 * 1024 * 1024  # 10 MB
         backup_count = 3
 
-        file_handler = RotatingFileHandler(f'logs/{self.strategy_name}.log',
-                                                   maxBytes = max_file_size,
-                                                   backupCount = backup_count)
-        file_handler.setLevel(logging.INFO)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        file_handler.setFormatter(formatter)
-        self.logger.addHandler(file_handler)
+        # loggers are shared by name: a gridsearch creating thousands of strategies opens the file only once
+        log_file = os.path.abspath(f'logs/{self.strategy_name}.log')
+        if not any(isinstance(h, RotatingFileHandler) and h.baseFilename == log_file for h in self.logger.handlers):
+            file_handler = RotatingFileHandler(log_file,
+                                               maxBytes = max_file_size,
+                                               backupCount = backup_count)
+            file_handler.setLevel(logging.INFO)
+            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+            file_handler.setFormatter(formatter)
+            self.logger.addHandler(file_handler)
 
     def run(self):
         while not self.exit_flag.is_set():
@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, Union
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
@@ -129,29 +129,24 @@ def interval_to_minutes(interval: str) -> int:
 
 
 ## <Signals & indicators> ##
+def _streak_lengths(condition: np.ndarray) -> np.ndarray:
+    """Length of the run of consecutive True values ending at each row (0 where condition is False)"""
+    count = np.cumsum(condition)
+    # cumulative count at the last False row, carried forward
+    reset = np.maximum.accumulate(np.where(condition, 0, count))
+    return count - reset
+
+
 def _add_macd_momentum(df, prefix, consecutive_rows):
-    # Define the conditions for 'MACD_UP_Momentum' and 'MACD_DOWN_Momentum'
-    macd_hist_prev = df[f'{prefix}_MACD_Hist'].shift(1)
-    macd_up_count = 0
-    macd_down_count = 0
-    macd_up = np.zeros(len(df), dtype=bool)
-    macd_down = np.zeros(len(df), dtype=bool)
-
-    for i in range(1, len(df)):
-        if df[f'{prefix}_MACD_Hist'].iloc[i] > macd_hist_prev.iloc[i]:
-            macd_up_count += 1
-            macd_down_count = 0
-        elif df[f'{prefix}_MACD_Hist'].iloc[i] < macd_hist_prev.iloc[i]:
-            macd_down_count += 1
-            macd_up_count = 0
-        else:
-            macd_up_count = 0
-            macd_down_count = 0
-
-        if macd_up_count >= consecutive_rows:
-            macd_up[i] = True
-        if macd_down_count >= consecutive_rows:
-            macd_down[i] = True
+    # 'MACD_UP_Momentum': the histogram rose for at least consecutive_rows rows in a row, 'MACD_DOWN_Momentum' fell
+    macd_hist = df[f'{prefix}_MACD_Hist'].values.astype('float64')
+    macd_hist_diff = np.diff(macd_hist, prepend=np.nan)  # NaN comparisons are False: streaks reset on NaN
+
+    macd_up = _streak_lengths(macd_hist_diff > 0) >= consecutive_rows
+    macd_down = _streak_lengths(macd_hist_diff < 0) >= consecutive_rows
+    if len(df):
+        # first row has no previous histogram
+        macd_up[0] = macd_down[0] = False
 
     # Add the columns to the dataframe
     df[f'{prefix}_MACD_UP_Momentum'] = macd_up
@@ -173,7 +168,11 @@ def add_indicators(df, prefix, consecutive_hist_before_momentum):
     return df
 
 
-def get_indicators_signals(row: pd.Series, prefix, rsi_oversold, rsi_overbought) -> Dict[str, bool]:
+def get_indicators_signals(row: Union[pd.Series, pd.DataFrame], prefix, rsi_oversold, rsi_overbought) -> Dict:
+    """
+    Signals of one row, or of every row at once when given a DataFrame (the comparisons are element-wise):
+    {signal column name: bool or boolean Series}
+    """
     short_above_long = row[f'{prefix}_Short_EMA'] > row[f'{prefix}_Long_EMA']
     oversold = row[f'{prefix}_RSI'] < rsi_oversold
     overbought = row[f'{prefix}_RSI'] > rsi_overbought
@@ -189,18 +188,34 @@ def get_indicators_signals(row: pd.Series, prefix, rsi_oversold, rsi_overbought)
 
 
 def add_indicators_signals(df: pd.DataFrame, prefix, rsi_oversold, rsi_overbought) -> pd.DataFrame:
-    signals = df.apply(lambda x: get_indicators_signals(x,
-                                                        prefix=prefix,
-                                                        rsi_oversold=rsi_oversold,
-                                                        rsi_overbought=rsi_overbought),
-                       axis=1)
+    # Column-wise comparisons: one pass per signal instead of one python call per row
+    signals = get_indicators_signals(df, prefix=prefix, rsi_oversold=rsi_oversold, rsi_overbought=rsi_overbought)
 
-    signals_df = pd.DataFrame.from_records(signals.values, index=signals.index)
+    signals_df = pd.DataFrame({name: np.asarray(values, dtype=bool) for name, values in signals.items()},
+                              index=df.index)
     result_df = pd.concat([df, signals_df], axis=1)
     return result_df
 
 
-def short_term_df_with_other_time_frames_signals(short_df_with_signals, *other_time_frames):
+def as_datetime(values):
+    # pd.to_datetime is slow on columns that are already datetimes
+    return values if pd.api.types.is_datetime64_any_dtype(values) else pd.to_datetime(values)
+
+
+def close_times_ms(df) -> np.ndarray:
+    return as_datetime(df['Close time']).values.astype('datetime64[ms]').astype(np.int64)
+
+
+def time_frames_alignment_indexes(short_df, *other_time_frames):
+    """
+    For each higher time frame, the row whose Close time is the closest in the past (or equal) of every short term
+    Close time, -1 when there is none. Every dataframe must be sorted by Close time.
+    """
+    short_close_times = close_times_ms(short_df)
+    return [np.searchsorted(close_times_ms(df), short_close_times, side='right') - 1 for df in other_time_frames]
+
+
+def short_term_df_with_other_time_frames_signals(short_df_with_signals, *other_time_frames, alignment_indexes=None):
     """
     Returns the short term dataframe with signals columns from the higher time frames dataframes.
     For every Close time (in short term dataframe), the function returns the higher time frame signal value
@@ -208,23 +223,35 @@ def short_term_df_with_other_time_frames_signals(short_df_with_signals, *other_t
 
     :param short_df_with_signals: pandas DataFrame containing the short term data with 'signal' columns.
     :param other_time_frames: variable number of pandas DataFrames for the higher time frames.
+    :param alignment_indexes: time_frames_alignment_indexes of these dataframes, computed here when not given.
     :return: pandas DataFrame containing the short term data with signals from the higher time frames.
     """
     # Convert Close time columns to datetime
-    short_df_with_signals['Close time'] = pd.to_datetime(short_df_with_signals['Close time'])
-    for df in other_time_frames:
-        df['Close time'] = pd.to_datetime(df['Close time'])
-
-    # Merge short term and higher time frame dataframes
-    merged_df = short_df_with_signals
+    short_df_with_signals['Close time'] = as_datetime(short_df_with_signals['Close time'])
     for df in other_time_frames:
-        specific_columns = [col for col in df.columns if col not in merged_df.columns]
-        merged_df = pd.merge_asof(merged_df.sort_values('Close time'),
-                                  df[['Close time'] + specific_columns].sort_values('Close time'),
-                                  on='Close time',
-                                  direction='backward')
-
-    return merged_df
+        df['Close time'] = as_datetime(df['Close time'])
+
+    if not short_df_with_signals['Close time'].is_monotonic_increasing:
+        short_df_with_signals = short_df_with_signals.sort_values('Close time')
+    other_time_frames = [df if df['Close time'].is_monotonic_increasing else df.sort_values('Close time')
+                         for df in other_time_frames]
+    if alignment_indexes is None:
+        alignment_indexes = time_frames_alignment_indexes(short_df_with_signals, *other_time_frames)
+
+    # Gather the higher time frames columns by row position (-1: no higher candle closed yet, NaN as merge_asof
+    # leaves it): same result as a backward merge_asof on Close time, without sorting nor merging.
+    # Signal columns stay boolean: no higher candle closed yet means no signal (False)
+    merged_columns = list(short_df_with_signals.columns)
+    gathered = [short_df_with_signals.reset_index(drop=True)]
+    for df, index in zip(other_time_frames, alignment_indexes):
+        specific_columns = [col for col in df.columns if col not in merged_columns]
+        higher_columns = df[specific_columns].reset_index(drop=True).reindex(index).reset_index(drop=True)
+        signal_columns = [col for col in specific_columns if SIGNAL_PREFIX in col]
+        higher_columns[signal_columns] = higher_columns[signal_columns].fillna(False).astype(bool)
+        gathered.append(higher_columns)
+        merged_columns += specific_columns
+
+    return pd.concat(gathered, axis=1)
 
 ## </Signals & indicators> ##
 
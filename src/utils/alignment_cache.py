@@ -0,0 +1,46 @@
+import threading
+
+import cachetools
+
+from src.utils import time_frames_alignment_indexes, close_times_ms
+
+
+class AlignmentIndexCache:
+    """
+    time_frames_alignment_indexes per (symbol, intervals, data range): backtests of the same symbol and time frames
+    over the same candles (a gridsearch) compute the short -> higher time frames row mappings once.
+    The data range of a dataframe is its length with its first and last Close times.
+    """
+
+    def __init__(self, maxsize=64):
+        self._indexes = cachetools.LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(symbol, intervals, short_df, *other_time_frames):
+        data_range = []
+        for df in (short_df, *other_time_frames):
+            close_times = close_times_ms(df)
+            data_range.append((len(close_times), int(close_times[0]), int(close_times[-1])) if len(close_times)
+                              else (0, None, None))
+        return symbol, tuple(intervals), tuple(data_range)
+
+    def get(self, symbol, intervals, short_df, *other_time_frames):
+        key = self.key(symbol, intervals, short_df, *other_time_frames)
+        with self._lock:
+            indexes = self._indexes.get(key)
+            if indexes is not None:
+                self.hits += 1
+                return indexes
+            self.misses += 1
+
+        indexes = time_frames_alignment_indexes(short_df, *other_time_frames)
+        with self._lock:
+            self._indexes[key] = indexes
+        return indexes
+
+
+DEFAULT_ALIGNMENT_CACHE = AlignmentIndexCache()
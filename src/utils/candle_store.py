@@ -0,0 +1,178 @@
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+STORE_VERSION = 1
+
+# Column name -> dtype. Timestamps are int64 epoch milliseconds (UTC), prices and volumes float64
+STORE_COLUMNS = {
+    'Open time': np.int64,
+    'Open': np.float64,
+    'High': np.float64,
+    'Low': np.float64,
+    'Close': np.float64,
+    'Volume': np.float64,
+    'Close time': np.int64,
+    'Quote asset volume': np.float64,
+    'Number of trades': np.int64,
+    'Taker buy base asset volume': np.float64,
+    'Taker buy quote asset volume': np.float64,
+}
+TIME_COLUMNS = ['Open time', 'Close time']
+
+
+def _column_file(column):
+    return column.lower().replace(' ', '_') + '.bin'
+
+
+def datetime_to_ms(values):
+    """datetime64 column (or ms integers) -> int64 epoch milliseconds"""
+    values = pd.Series(values)
+    if pd.api.types.is_datetime64_any_dtype(values):
+        if values.dt.tz is not None:
+            values = values.dt.tz_convert('UTC').dt.tz_localize(None)
+        return values.values.astype('datetime64[ms]').astype(np.int64)
+    return values.values.astype(np.int64)
+
+
+class CandleStore:
+    """
+    Candles of each (symbol, interval) stored column by column as raw little-endian arrays
+    ({root}/{symbol}_{interval}/open_time.bin, close.bin...) next to a small meta.json header holding the row count.
+    Appending only writes the new rows, reads are memory-mapped and can be restricted to a time range.
+    """
+
+    def __init__(self, root='candles'):
+        self.root = root
+        self._lock = threading.Lock()
+
+    def path(self, symbol, interval):
+        return os.path.join(self.root, f'{symbol}_{interval}')
+
+    def _meta_path(self, symbol, interval):
+        return os.path.join(self.path(symbol, interval), 'meta.json')
+
+    def exists(self, symbol, interval):
+        return os.path.isfile(self._meta_path(symbol, interval))
+
+    def mtime(self, symbol, interval):
+        return os.path.getmtime(self._meta_path(symbol, interval))
+
+    def rows(self, symbol, interval):
+        if not self.exists(symbol, interval):
+            return 0
+        with open(self._meta_path(symbol, interval), 'r') as f:
+            return json.load(f)['rows']
+
+    def _write_meta(self, symbol, interval, rows):
+        meta_path = self._meta_path(symbol, interval)
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump({'version': STORE_VERSION,
+                       'rows': rows,
+                       'columns': [[c, np.dtype(d).str, _column_file(c)] for c, d in STORE_COLUMNS.items()]}, f)
+        # The row count is committed last: a crash mid-write leaves extra bytes that are never read
+        os.replace(meta_path + '.tmp', meta_path)
+
+    @staticmethod
+    def _to_arrays(df):
+        arrays = {}
+        for column, dtype in STORE_COLUMNS.items():
+            if column in TIME_COLUMNS:
+                arrays[column] = datetime_to_ms(df[column])
+            else:
+                arrays[column] = pd.to_numeric(df[column]).values.astype(dtype)
+        return arrays
+
+    def write(self, symbol, interval, df):
+        """Replace the stored candles of (symbol, interval) with the ones of df"""
+        self.write_arrays(symbol, interval, self._to_arrays(df))
+
+    def write_arrays(self, symbol, interval, arrays):
+        """Same as write, from a dict column -> array holding every STORE_COLUMNS"""
+        rows = len(arrays['Open time'])
+        with self._lock:
+            os.makedirs(self.path(symbol, interval), exist_ok=True)
+            if self.rows(symbol, interval) > rows:
+                # readers opening the store meanwhile never map more rows than the new files hold
+                self._write_meta(symbol, interval, rows)
+            for column, dtype in STORE_COLUMNS.items():
+                # new files replacing the old ones, never truncated in place: memory maps of the old files (another
+                # process, a live strategy) keep their pages
+                column_path = os.path.join(self.path(symbol, interval), _column_file(column))
+                with open(f'{column_path}.{os.getpid()}.tmp', 'wb') as f:
+                    f.write(np.ascontiguousarray(arrays[column], dtype=dtype).tobytes())
+                os.replace(f'{column_path}.{os.getpid()}.tmp', column_path)
+            self._write_meta(symbol, interval, rows)
+
+    def append(self, symbol, interval, df):
+        """
+        Append candles, replacing the stored ones from the first new 'Open time' onwards
+        (typically the candle that was still open at the previous write).
+        """
+        if df.empty and self.exists(symbol, interval):
+            return
+        self.append_arrays(symbol, interval, self._to_arrays(df))
+
+    def append_arrays(self, symbol, interval, arrays):
+        """Same as append, from a dict column -> array holding every STORE_COLUMNS"""
+        if not self.exists(symbol, interval):
+            return self.write_arrays(symbol, interval, arrays)
+        if len(arrays['Open time']) == 0:
+            return
+
+        with self._lock:
+            rows = self.rows(symbol, interval)
+            open_times = self._memmap(symbol, interval, 'Open time', rows)
+            keep = int(np.searchsorted(open_times, arrays['Open time'][0], side='left'))
+            del open_times
+
+            for column, dtype in STORE_COLUMNS.items():
+                with open(os.path.join(self.path(symbol, interval), _column_file(column)), 'r+b') as f:
+                    # Overwrite in place rather than truncating: files never shrink under live memory maps
+                    f.seek(keep * np.dtype(dtype).itemsize)
+                    f.write(np.ascontiguousarray(arrays[column], dtype=dtype).tobytes())
+            self._write_meta(symbol, interval, keep + len(arrays['Open time']))
+
+    def _memmap(self, symbol, interval, column, rows):
+        if rows == 0:
+            return np.empty(0, dtype=STORE_COLUMNS[column])
+        return np.memmap(os.path.join(self.path(symbol, interval), _column_file(column)),
+                         dtype=STORE_COLUMNS[column], mode='r', shape=(rows,))
+
+    def read(self, symbol, interval, start_ms=None, end_ms=None, columns=None):
+        """
+        Memory-mapped columns of the candles whose 'Open time' is in [start_ms, end_ms).
+        :return: dict column -> read-only array view
+        """
+        rows = self.rows(symbol, interval)
+        open_times = self._memmap(symbol, interval, 'Open time', rows)
+        first = 0 if start_ms is None else int(np.searchsorted(open_times, start_ms, side='left'))
+        last = rows if end_ms is None else int(np.searchsorted(open_times, end_ms, side='left'))
+
+        return {column: self._memmap(symbol, interval, column, rows)[first:last]
+                for column in (columns or STORE_COLUMNS)}
+
+    def read_frame(self, symbol, interval, start_ms=None, end_ms=None):
+        """Same as read, as a DataFrame with naive UTC datetimes"""
+        arrays = self.read(symbol, interval, start_ms, end_ms)
+        df = pd.DataFrame({column: np.array(values) for column, values in arrays.items()})
+        for column in TIME_COLUMNS:
+            df[column] = pd.to_datetime(df[column], unit='ms')
+        return df
+
+    def import_csv(self, symbol, interval, csv_path):
+        df = pd.read_csv(csv_path, parse_dates=TIME_COLUMNS)
+        self.write(symbol, interval, df)
+        logger.info(f'imported {csv_path} into {self.path(symbol, interval)}: {len(df)} candles')
+
+    def import_csv_if_newer(self, symbol, interval, csv_path):
+        """Import csv_path when it exists and was modified after the stored candles (or there are none)"""
+        if os.path.isfile(csv_path) and \
+                (not self.exists(symbol, interval) or os.path.getmtime(csv_path) > self.mtime(symbol, interval)):
+            self.import_csv(symbol, interval, csv_path)
@@ -0,0 +1,146 @@
+import hashlib
+import logging
+import os
+import threading
+
+import cachetools
+import numpy as np
+
+from src.utils import add_indicators
+from src.utils.candle_store import datetime_to_ms
+
+logger = logging.getLogger(__name__)
+
+INDICATORS_VERSION = 1  # bump when add_indicators changes: older cache entries are then never hit
+
+
+def indicator_columns(prefix):
+    return [f'{prefix}_RSI', f'{prefix}_Short_EMA', f'{prefix}_Long_EMA',
+            f'{prefix}_MACD_Hist', f'{prefix}_MACD_UP_Momentum', f'{prefix}_MACD_DOWN_Momentum']
+
+
+class IndicatorCache:
+    """
+    Outputs of add_indicators keyed by a hash of their inputs (close prices and times of the candles, prefix,
+    consecutive_hist_before_momentum), so that backtests sharing the same candles and indicator parameters only
+    compute them once, whatever their tp / sl / rsi thresholds.
+
+    Two tiers: an in-memory LRU bounded to `max_memory_bytes`, optionally backed by .npz files in `path` bounded to
+    `max_disk_bytes` (least recently used files deleted first), which also survive restarts and are shared by the
+    gridsearch worker processes. The disk tier is opt-in (path=None skips it): small boards run this too.
+    """
+
+    def __init__(self, path=None, max_memory_bytes=128 * 2 ** 20, max_disk_bytes=512 * 2 ** 20):
+        self.path = path
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = cachetools.LRUCache(maxsize=max_memory_bytes,
+                                           getsizeof=lambda arrays: sum(a.nbytes for a in arrays.values()))
+        self._lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(df, prefix, consecutive_hist_before_momentum):
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f'{INDICATORS_VERSION}|{prefix}|{consecutive_hist_before_momentum}|'.encode())
+        digest.update(np.ascontiguousarray(datetime_to_ms(df['Close time'])).tobytes())
+        digest.update(np.ascontiguousarray(df['Close'].values, dtype=np.float64).tobytes())
+        return digest.hexdigest()
+
+    def stats(self):
+        return {'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'memory_bytes': self._memory.currsize}
+
+    def add_indicators(self, df, prefix, consecutive_hist_before_momentum):
+        """Same as src.utils.add_indicators, served from the cache when these candles were already computed"""
+        key = self.key(df, prefix, consecutive_hist_before_momentum)
+        columns = indicator_columns(prefix)
+
+        arrays = self._get(key)
+        if arrays is None:
+            df = add_indicators(df, prefix=prefix, consecutive_hist_before_momentum=consecutive_hist_before_momentum)
+            arrays = {column: df[column].values.copy() for column in columns}
+            self._put(key, arrays)
+            return df
+
+        for column in columns:
+            df[column] = arrays[column].copy()
+        return df
+
+    def _get(self, key):
+        with self._lock:
+            arrays = self._memory.get(key)
+            if arrays is not None:
+                self.memory_hits += 1
+                return arrays
+
+            arrays = self._read_disk(key)
+            if arrays is not None:
+                self.disk_hits += 1
+                self._memory[key] = arrays
+                return arrays
+
+            self.misses += 1
+            return None
+
+    def _put(self, key, arrays):
+        with self._lock:
+            try:
+                self._memory[key] = arrays
+            except ValueError:  # larger than the whole memory tier
+                pass
+            self._write_disk(key, arrays)
+
+    def _file(self, key):
+        return os.path.join(self.path, f'{key}.npz')
+
+    def _read_disk(self, key):
+        if self.path is None or not os.path.isfile(self._file(key)):
+            return None
+        try:
+            with np.load(self._file(key)) as npz:
+                arrays = {column: npz[column] for column in npz.files}
+        except (OSError, ValueError) as e:
+            logger.warning(f'ignoring unreadable indicators cache entry {self._file(key)}: {e}')
+            return None
+        try:
+            os.utime(self._file(key))  # mtime tracks the last use, for eviction
+        except FileNotFoundError:  # evicted by another process meanwhile
+            pass
+        return arrays
+
+    def _write_disk(self, key, arrays):
+        if self.path is None:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = f'{self._file(key)}.{os.getpid()}.tmp'  # gridsearch workers may write the same key at once
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, self._file(key))
+        self._evict_disk()
+
+    def _evict_disk(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except FileNotFoundError:  # other processes share the directory
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+# Shared by every strategy of the process, in memory only: IndicatorCache('indicators_cache') to keep them on disk
+DEFAULT_INDICATOR_CACHE = IndicatorCache()
@@ -0,0 +1,99 @@
+import logging
+import threading
+
+import numpy as np
+
+from src.utils import interval_to_milliseconds
+from src.utils.candle_store import STORE_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+# Binance weekly candles open on Monday 00:00 UTC, the epoch was a Thursday
+WEEK_OFFSET_MS = 4 * 24 * 60 * 60 * 1000
+
+SUM_COLUMNS = ['Volume', 'Quote asset volume', 'Number of trades',
+               'Taker buy base asset volume', 'Taker buy quote asset volume']
+
+
+def bucket_open_times(open_times, interval):
+    """Open time of the `interval` candle containing each open time, on Binance's UTC boundaries"""
+    if interval.endswith('M'):
+        raise ValueError('monthly candles are not on fixed boundaries: they cannot be resampled locally')
+    interval_ms = interval_to_milliseconds(interval)
+    offset = WEEK_OFFSET_MS if interval.endswith('w') else 0
+    return (open_times - offset) // interval_ms * interval_ms + offset
+
+
+def resample_candles(arrays, base_interval, interval):
+    """
+    OHLCV candles of `interval` built from sorted candles of the finer `base_interval`.
+    :param arrays: dict column -> array, as returned by CandleStore.read
+    :return: dict column -> array for every STORE_COLUMNS; the last candle is partial when its period is not over
+    """
+    interval_ms = interval_to_milliseconds(interval)
+    if interval_ms % interval_to_milliseconds(base_interval):
+        raise ValueError(f'{interval} candles cannot be built from {base_interval} ones')
+
+    open_times = np.asarray(arrays['Open time'])
+    if len(open_times) == 0:
+        return {column: np.empty(0, dtype=dtype) for column, dtype in STORE_COLUMNS.items()}
+
+    buckets = bucket_open_times(open_times, interval)
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    ends = np.r_[starts[1:], len(open_times)] - 1
+
+    ret = {'Open time': buckets[starts],
+           'Open': np.asarray(arrays['Open'])[starts],
+           'High': np.maximum.reduceat(arrays['High'], starts),
+           'Low': np.minimum.reduceat(arrays['Low'], starts),
+           'Close': np.asarray(arrays['Close'])[ends],
+           'Close time': buckets[starts] + interval_ms - 1}
+    ret.update({column: np.add.reduceat(arrays[column], starts) for column in SUM_COLUMNS})
+    return {column: ret[column].astype(dtype) for column, dtype in STORE_COLUMNS.items()}
+
+
+def resampled_interval(interval, base_interval):
+    """Name of the CandleStore entry holding `interval` candles built from `base_interval` ones"""
+    return interval if interval == base_interval else f'{interval}_from_{base_interval}'
+
+
+class CandleResampler:
+    """
+    Higher time frames of a symbol built locally from the candles of a single base interval of a CandleStore, so that
+    multi time frame strategies only download and store one feed per symbol.
+
+    The resampled candles are stored next to the base ones (under resampled_interval names). Updates only rebuild
+    them from the last stored candle (partial at the previous update) onwards.
+    """
+
+    def __init__(self, candle_store):
+        self.candle_store = candle_store
+        self._lock = threading.Lock()
+
+    def update(self, symbol, base_interval, interval):
+        target = resampled_interval(interval, base_interval)
+        if target == base_interval:
+            return target
+
+        with self._lock:
+            start_ms = self._resume_from(symbol, base_interval, interval, target)
+            base = self.candle_store.read(symbol, base_interval, start_ms=start_ms)
+            resampled = resample_candles(base, base_interval, interval)
+
+            if start_ms is None:
+                self.candle_store.write_arrays(symbol, target, resampled)
+                logger.info(f'{symbol} {interval} built from {base_interval}: {len(resampled["Open time"])} candles')
+            elif len(resampled['Open time']):
+                self.candle_store.append_arrays(symbol, target, resampled)
+        return target
+
+    def _resume_from(self, symbol, base_interval, interval, target):
+        # Open time of the last resampled candle, None when everything has to be rebuilt
+        if not self.candle_store.exists(symbol, target):
+            return None
+        stored = self.candle_store.read(symbol, target, columns=['Open time'])['Open time']
+        first_base = self.candle_store.read(symbol, base_interval, columns=['Open time'])['Open time'][:1]
+        if len(stored) == 0 or len(first_base) == 0 or bucket_open_times(first_base, interval)[0] != stored[0]:
+            # base candles replaced (older history imported...): the resampled ones do not match anymore
+            return None
+        return int(stored[-1])
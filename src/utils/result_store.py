@@ -0,0 +1,91 @@
+import hashlib
+import json
+import sqlite3
+import threading
+
+PARAM_COLUMNS = {
+    'symbol': 'TEXT',
+    'long_interval': 'TEXT',
+    'medium_interval': 'TEXT',
+    'short_interval': 'TEXT',
+    'tp_threshold': 'REAL',
+    'sl_ratio_to_tp_threshold': 'REAL',
+    'rsi_oversold': 'REAL',
+    'consecutive_hist_before_momentum': 'INTEGER',
+}
+
+
+def _plain(value):
+    """Python scalar of a numpy one (np.float64, np.int64...): grids are often built with np.arange / np.linspace"""
+    return value.item() if hasattr(value, 'item') else value
+
+
+def _plain_params(params):
+    return {name: _plain(value) for name, value in params.items()}
+
+
+def params_hash(params):
+    return hashlib.sha1(json.dumps(_plain_params(params), sort_keys=True).encode()).hexdigest()
+
+
+class GridsearchResultStore:
+    """
+    Gridsearch results ({'score': ..., 'params': {...}}) in a SQLite table keyed by a hash of their params, written as
+    they come: an interrupted gridsearch resumes where it stopped, and the best results can be queried (top / filter
+    on any parameter) without loading the others.
+    """
+
+    def __init__(self, path='gridsearch_results.sqlite'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        # WAL: a reader (print_cached_results) does not block the running gridsearch
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        columns = ', '.join(f'{column} {sql_type}' for column, sql_type in PARAM_COLUMNS.items())
+        with self._connection:
+            self._connection.execute(f'CREATE TABLE IF NOT EXISTS results '
+                                     f'(params_hash TEXT PRIMARY KEY, score REAL, {columns}, params TEXT)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS results_score ON results (score DESC)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS results_symbol_score ON results (symbol, score DESC)')
+
+    def close(self):
+        self._connection.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def add(self, results):
+        """Insert (or replace) results, committed at once"""
+        rows = []
+        for result in results:
+            params = _plain_params(result['params'])
+            rows.append((params_hash(params), float(result['score']),
+                         *[params.get(column) for column in PARAM_COLUMNS], json.dumps(params)))
+        placeholders = ', '.join('?' * (len(PARAM_COLUMNS) + 3))
+        with self._lock, self._connection:
+            self._connection.executemany(f'INSERT OR REPLACE INTO results VALUES ({placeholders})', rows)
+
+    def get(self, params_list):
+        """{params_hash: result} of the params already stored"""
+        hashes = [params_hash(params) for params in params_list]
+        ret = {}
+        with self._lock:
+            for first in range(0, len(hashes), 500):  # below SQLite's bound variables limit
+                chunk = hashes[first:first + 500]
+                rows = self._connection.execute(f'SELECT params_hash, score, params FROM results '
+                                                f'WHERE params_hash IN ({", ".join("?" * len(chunk))})', chunk)
+                ret.update({h: {'score': score, 'params': json.loads(params)} for h, score, params in rows})
+        return ret
+
+    def top(self, n=20, **filters):
+        """Best n results, optionally filtered on parameters values: top(10, symbol='BNBEUR', short_interval='5m')"""
+        unknown = set(filters) - set(PARAM_COLUMNS)
+        if unknown:
+            raise ValueError(f'unknown parameters {unknown}, expected some of {list(PARAM_COLUMNS)}')
+        where = ' AND '.join(f'{column} = ?' for column in filters)
+        query = f'SELECT score, params FROM results {"WHERE " + where if where else ""} ORDER BY score DESC LIMIT ?'
+        with self._lock:
+            rows = self._connection.execute(query, [*map(_plain, filters.values()), n]).fetchall()
+        return [{'score': score, 'params': json.loads(params)} for score, params in rows]
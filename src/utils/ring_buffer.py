@@ -0,0 +1,105 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+RING_MAGIC = 0x5454524E47  # 'TTRNG'
+HEADER_FIELDS = 4  # magic, capacity, count, head
+TIME_COLUMNS = ['Open time', 'Close time']
+VALUE_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume']
+
+
+class OHLCVRingBuffer:
+    """
+    Fixed-capacity, memory-mapped ring of the last `capacity` candles of one (symbol, interval).
+
+    Every column is stored twice in a row of 2 * capacity slots (candle k at k % capacity and k % capacity + capacity),
+    so the latest candles always form one contiguous slice: `view()` hands out NumPy views without copying, and
+    appending a candle is O(1). Memory use only depends on the capacity, however long the process runs.
+    """
+
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        n_slots = 2 * capacity
+        size = (HEADER_FIELDS + len(TIME_COLUMNS) * n_slots + len(VALUE_COLUMNS) * n_slots) * 8
+
+        fresh = not os.path.isfile(path) or os.path.getsize(path) != size
+        if fresh:
+            # a new file replacing the old one, never truncated in place: views still mapping it keep their pages
+            with open(f'{path}.{os.getpid()}.tmp', 'wb') as f:
+                f.truncate(size)
+            os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+        self._header = np.memmap(path, dtype=np.int64, mode='r+', shape=(HEADER_FIELDS,))
+        self._times = np.memmap(path, dtype=np.int64, mode='r+', offset=HEADER_FIELDS * 8,
+                                shape=(len(TIME_COLUMNS), n_slots))
+        self._values = np.memmap(path, dtype=np.float64, mode='r+',
+                                 offset=(HEADER_FIELDS + len(TIME_COLUMNS) * n_slots) * 8,
+                                 shape=(len(VALUE_COLUMNS), n_slots))
+
+        if fresh or self._header[0] != RING_MAGIC or self._header[1] != capacity:
+            self.clear()
+
+    def clear(self):
+        self._header[:] = [RING_MAGIC, self.capacity, 0, 0]
+
+    def __len__(self):
+        return int(self._header[2])
+
+    @property
+    def _head(self):
+        return int(self._header[3])
+
+    def _write(self, slot, open_time, close_time, values):
+        for s in (slot, slot + self.capacity):
+            self._times[0, s] = open_time
+            self._times[1, s] = close_time
+            self._values[:, s] = values
+
+    def append(self, open_time, close_time, values):
+        """values: Open, High, Low, Close, Volume"""
+        head = self._head
+        self._write(head, open_time, close_time, values)
+        self._header[3] = (head + 1) % self.capacity
+        self._header[2] = min(len(self) + 1, self.capacity)
+
+    def last_open_time(self):
+        return int(self._times[0, (self._head - 1) % self.capacity]) if len(self) else None
+
+    def push(self, open_time, close_time, values):
+        """Append a candle, or update the last one when it has the same open time (candle still open)"""
+        if len(self) and self.last_open_time() == open_time:
+            self._write((self._head - 1) % self.capacity, open_time, close_time, values)
+        elif len(self) and open_time < self.last_open_time():
+            raise ValueError(f'{self.path}: candle at {open_time} is older than the last one')
+        else:
+            self.append(open_time, close_time, values)
+
+    def extend(self, open_times, close_times, values):
+        """values: array of shape (n, 5) ordered like VALUE_COLUMNS"""
+        for open_time, close_time, row in zip(open_times, close_times, values):
+            self.push(int(open_time), int(close_time), row)
+
+    def view(self):
+        """Zero-copy views of the stored candles, oldest first: dict column -> array"""
+        start = self._head + self.capacity - len(self)
+        end = start + len(self)
+        ret = {'Open time': self._times[0, start:end]}
+        ret.update({column: self._values[i, start:end] for i, column in enumerate(VALUE_COLUMNS)})
+        ret['Close time'] = self._times[1, start:end]
+        return ret
+
+    def to_frame(self, start_ms=None):
+        """DataFrame (naive UTC datetimes) of the candles opened from start_ms"""
+        arrays = self.view()
+        first = 0 if start_ms is None else int(np.searchsorted(arrays['Open time'], start_ms, side='left'))
+        df = pd.DataFrame({column: values[first:] for column, values in arrays.items()})
+        for column in TIME_COLUMNS:
+            df[column] = pd.to_datetime(df[column], unit='ms')
+        return df
+
+    def flush(self):
+        self._header.flush()
+        self._times.flush()
+        self._values.flush()
@@ -0,0 +1,81 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from src.utils.candle_store import CandleStore, STORE_COLUMNS
+
+
+class SharedCandleStore(CandleStore):
+    """
+    Read-only CandleStore whose candles live in multiprocessing shared memory: the process running a gridsearch
+    publishes every (symbol, interval) once, and the worker processes attach to the same pages instead of each
+    reading and copying them. One block per (symbol, interval), holding the STORE_COLUMNS one after the other.
+
+    Only the publishing process unlinks the blocks (`unlink`), the workers just `close` their mappings.
+    """
+
+    def __init__(self, blocks, rows, owner=False):
+        super().__init__(root=None)
+        self._blocks = blocks  # (symbol, interval) -> SharedMemory
+        self._rows = rows  # (symbol, interval) -> number of candles
+        self._owner = owner
+
+    @classmethod
+    def publish(cls, candle_store: CandleStore, keys):
+        """Copy the candles of each (symbol, interval) of `keys` from candle_store to new shared memory blocks"""
+        blocks, rows = {}, {}
+        for symbol, interval in keys:
+            arrays = candle_store.read(symbol, interval)
+            n = len(arrays['Open time'])
+            block = shared_memory.SharedMemory(create=True, size=max(1, n * 8 * len(STORE_COLUMNS)))
+            for i, (column, dtype) in enumerate(STORE_COLUMNS.items()):
+                np.ndarray((n,), dtype=dtype, buffer=block.buf, offset=i * n * 8)[:] = arrays[column]
+            blocks[(symbol, interval)], rows[(symbol, interval)] = block, n
+        return cls(blocks, rows, owner=True)
+
+    def descriptor(self):
+        """Picklable description of the blocks, for `attach` in another process"""
+        return {key: (block.name, self._rows[key]) for key, block in self._blocks.items()}
+
+    @classmethod
+    def attach(cls, descriptor):
+        blocks = {key: shared_memory.SharedMemory(name=name) for key, (name, _) in descriptor.items()}
+        return cls(blocks, {key: rows for key, (_, rows) in descriptor.items()})
+
+    def close(self):
+        for block in self._blocks.values():
+            block.close()
+
+    def unlink(self):
+        assert self._owner, 'only the publishing process unlinks the shared candles'
+        self.close()
+        for block in self._blocks.values():
+            block.unlink()
+
+    def path(self, symbol, interval):
+        return f'shm://{symbol}_{interval}'
+
+    def exists(self, symbol, interval):
+        return (symbol, interval) in self._blocks
+
+    def mtime(self, symbol, interval):
+        return float('inf')
+
+    def rows(self, symbol, interval):
+        return self._rows.get((symbol, interval), 0)
+
+    def _memmap(self, symbol, interval, column, rows):
+        i = list(STORE_COLUMNS).index(column)
+        values = np.ndarray((rows,), dtype=STORE_COLUMNS[column], buffer=self._blocks[(symbol, interval)].buf,
+                            offset=i * rows * 8)
+        values.flags.writeable = False
+        return values
+
+    def import_csv_if_newer(self, symbol, interval, csv_path):
+        pass  # imported by the publishing process before the candles were shared
+
+    def write_arrays(self, symbol, interval, arrays):
+        raise PermissionError(f'shared candles are read-only: cannot write {symbol} {interval}')
+
+    def append_arrays(self, symbol, interval, arrays):
+        raise PermissionError(f'shared candles are read-only: cannot write {symbol} {interval}')
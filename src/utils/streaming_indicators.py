@@ -0,0 +1,191 @@
+import copy
+import math
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+
+class StreamingEMA:
+    """
+    TA-Lib compatible EMA updated one value at a time: seeded with the simple average of its first `period`
+    values, then value = previous + k * (x - previous). The first `skip` values are ignored (TA-Lib's MACD starts
+    its fast EMA late so that both EMAs are seeded on the same candle).
+    """
+
+    def __init__(self, period, skip=0):
+        self.period = period
+        self.k = 2 / (period + 1)
+        self.skip = skip
+        self.seen = 0
+        self._seed_sum = 0.0
+        self.value = math.nan
+
+    def update(self, x):
+        self.seen += 1
+        if self.seen <= self.skip:
+            return math.nan
+
+        n = self.seen - self.skip
+        if n < self.period:
+            self._seed_sum += x
+        elif n == self.period:
+            self.value = (self._seed_sum + x) / self.period
+        else:
+            self.value += self.k * (x - self.value)
+        return self.value
+
+
+class StreamingRSI:
+    """TA-Lib compatible RSI: Wilder averages of gains and losses, seeded with their simple average"""
+
+    def __init__(self, period=14):
+        self.period = period
+        self.seen = 0
+        self.prev_close = None
+        self._avg_gain = 0.0
+        self._avg_loss = 0.0
+        self.value = math.nan
+
+    def update(self, close):
+        self.seen += 1
+        if self.prev_close is None:
+            self.prev_close = close
+            return math.nan
+
+        change = close - self.prev_close
+        self.prev_close = close
+        gain, loss = max(change, 0.0), max(-change, 0.0)
+
+        if self.seen <= self.period + 1:
+            self._avg_gain += gain / self.period
+            self._avg_loss += loss / self.period
+            if self.seen < self.period + 1:
+                return math.nan
+        else:
+            self._avg_gain = (self._avg_gain * (self.period - 1) + gain) / self.period
+            self._avg_loss = (self._avg_loss * (self.period - 1) + loss) / self.period
+
+        total = self._avg_gain + self._avg_loss
+        self.value = 100 * self._avg_gain / total if total != 0 else 0.0
+        return self.value
+
+
+class StreamingMACD:
+    """TA-Lib compatible MACD histogram (MACD line minus its signal EMA)"""
+
+    def __init__(self, fastperiod=12, slowperiod=26, signalperiod=9):
+        self.fast = StreamingEMA(fastperiod, skip=slowperiod - fastperiod)
+        self.slow = StreamingEMA(slowperiod)
+        self.signal = StreamingEMA(signalperiod)
+        self.hist = math.nan
+
+    def update(self, close):
+        fast, slow = self.fast.update(close), self.slow.update(close)
+        if math.isnan(slow):
+            return math.nan
+        macd = fast - slow
+        signal = self.signal.update(macd)
+        self.hist = macd - signal
+        return self.hist
+
+
+class StreamingMomentum:
+    """Consecutive rises / falls of a series, as in _add_macd_momentum"""
+
+    def __init__(self, consecutive_rows):
+        self.consecutive_rows = consecutive_rows
+        self.prev = math.nan
+        self.up_count = 0
+        self.down_count = 0
+        self.seen = 0
+
+    def update(self, x):
+        self.seen += 1
+        if x > self.prev:
+            self.up_count, self.down_count = self.up_count + 1, 0
+        elif x < self.prev:
+            self.up_count, self.down_count = 0, self.down_count + 1
+        else:  # equal or NaN
+            self.up_count = self.down_count = 0
+        self.prev = x
+
+        first_row = self.seen == 1
+        return (not first_row and self.up_count >= self.consecutive_rows,
+                not first_row and self.down_count >= self.consecutive_rows)
+
+
+class IndicatorEngine:
+    """
+    Running state of the indicators of add_indicators for one (symbol, interval, params), updated in constant time
+    per closed candle. `peek` evaluates a still-open candle without committing it.
+    The outputs of the last `history_size` closed candles are kept to fill the indicator columns of a frame.
+    """
+
+    def __init__(self, prefix, consecutive_hist_before_momentum, history_size=1000):
+        self.prefix = prefix
+        self.rsi = StreamingRSI(14)
+        self.short_ema = StreamingEMA(12)
+        self.long_ema = StreamingEMA(26)
+        self.macd = StreamingMACD(12, 26, 9)
+        self.momentum = StreamingMomentum(consecutive_hist_before_momentum)
+
+        self.last_close_time = None
+        self.history = deque(maxlen=history_size)  # (close time, indicator values) of closed candles
+
+    @property
+    def columns(self):
+        return [f'{self.prefix}_RSI', f'{self.prefix}_Short_EMA', f'{self.prefix}_Long_EMA',
+                f'{self.prefix}_MACD_Hist', f'{self.prefix}_MACD_UP_Momentum', f'{self.prefix}_MACD_DOWN_Momentum']
+
+    def update(self, close, close_time=None):
+        rsi = self.rsi.update(close)
+        short_ema = self.short_ema.update(close)
+        long_ema = self.long_ema.update(close)
+        macd_hist = self.macd.update(close)
+        momentum_up, momentum_down = self.momentum.update(macd_hist)
+
+        values = (rsi, short_ema, long_ema, macd_hist, momentum_up, momentum_down)
+        if close_time is not None:
+            self.last_close_time = close_time
+            self.history.append((close_time, values))
+        return values
+
+    def peek(self, close):
+        history, self.history = self.history, None
+        try:
+            # only the running states are copied, not the outputs history
+            engine = copy.deepcopy(self)
+        finally:
+            self.history = history
+        return engine.update(close)
+
+    def seed(self, closes, close_times):
+        for close, close_time in zip(closes, close_times):
+            self.update(close, close_time)
+
+    def add_indicators(self, df, now_ms):
+        """
+        Same columns as src.utils.add_indicators: candles closed before now_ms and not seen yet are committed,
+        a still-open last candle is only peeked at.
+        """
+        close_times = df['Close time'].values.astype('datetime64[ms]').astype(np.int64)
+        closes = df['Close'].values.astype('float64')
+
+        is_new = close_times > (self.last_close_time if self.last_close_time is not None else -1)
+        is_closed = close_times < now_ms
+        for close, close_time in zip(closes[is_new & is_closed], close_times[is_new & is_closed]):
+            self.update(close, int(close_time))
+
+        outputs = pd.DataFrame([values for _, values in self.history], columns=self.columns,
+                               index=[close_time for close_time, _ in self.history])
+        outputs = outputs.reindex(close_times)
+        if len(df) and is_new[-1] and not is_closed[-1]:
+            outputs.iloc[-1] = self.peek(closes[-1])
+
+        for column in self.columns:
+            values = outputs[column].values
+            if column.endswith('Momentum'):
+                values = values.astype(bool) & ~pd.isna(values)
+            df[column] = values
+        return df
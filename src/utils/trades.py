@@ -0,0 +1,271 @@
+import numpy as np
+
+
+def intrabar_rows(open_times, close_times, fine_open_times):
+    """
+    Index of finer candles (e.g. 1m) into bars: the rows [first, last) of the finer candles opened between the
+    Open time and the Close time of each bar, all in epoch ms.
+    """
+    fine_open_times = np.asarray(fine_open_times)
+    return (np.searchsorted(fine_open_times, open_times, side='left'),
+            np.searchsorted(fine_open_times, close_times, side='right'))
+
+
+def take_profit_first(first, last, fine_high, fine_low, reference, take_profit, stop_loss):
+    """
+    For bars reaching both the take profit and the stop loss of their reference price, whether the take profit was
+    reached first, replaying their finer candles [first, last) in order. When a finer candle reaches both levels, or a
+    bar has no finer candles, the order is still unknown and the stop loss is kept.
+
+    :return: bool array, one value per bar
+    """
+    first, last = np.asarray(first), np.asarray(last)
+    ret = np.zeros(len(first), dtype=bool)
+    undecided = np.ones(len(first), dtype=bool)
+    # the k-th finer candle of every bar at once: as many steps as finer candles per bar (5 for 5m over 1m)
+    for offset in range(int((last - first).max(initial=0))):
+        candidates = undecided & (first + offset < last)
+        rows = np.minimum(first + offset, len(fine_high) - 1)
+        stop_loss_hit = fine_low[rows] <= reference * (1 - stop_loss)
+        take_profit_hit = fine_high[rows] >= reference * (1 + take_profit)
+        decided = candidates & (stop_loss_hit | take_profit_hit)
+        ret |= decided & take_profit_hit & ~stop_loss_hit
+        undecided &= ~decided
+    return ret
+
+
+def simulate_oco_exits(close, high, low, buy, take_profit, stop_loss, in_position=False, last_buy_price=None,
+                       intrabar=None):
+    """
+    Array version of the buy / stop loss / take profit state machine of CallStrategyAtClose.apply_strategy:
+    a buy row (re)opens the position at its Close, then the first later row whose Low reaches the stop loss (checked
+    first) or whose High reaches the take profit closes it. Buys while in position move the reference price.
+
+    When a row reaches both levels, the bar alone cannot tell which was hit first. With `intrabar`, (first, last,
+    fine_high, fine_low) as given by intrabar_rows and finer candles, only those rows are resolved on their finer
+    candles (take_profit_first).
+
+    Every buy row starts a segment running until the next buy. The reference price is the Close of the segment's buy,
+    and the exit is the first stop loss / take profit hit of the segment. Rows before the first buy continue the
+    `in_position` / `last_buy_price` state given.
+
+    :return: (dict column -> bool array for 'Buy', 'Stop loss', 'Take profit', 'In position',
+              in_position, last_buy_price after the last row)
+    """
+    close, high, low = (np.asarray(a, dtype=np.float64) for a in (close, high, low))
+    buy = np.asarray(buy, dtype=bool)
+    rows = np.arange(len(close))
+
+    last_buy = np.maximum.accumulate(np.where(buy, rows, -1))  # row of the buy opening the segment, -1 before any
+    has_buy = last_buy >= 0
+    previous_reference = np.nan if last_buy_price is None else last_buy_price
+    reference = np.where(has_buy, close[np.maximum(last_buy, 0)], previous_reference)
+    opened = has_buy | in_position  # a position was opened in the segment (or was already open)
+
+    with np.errstate(invalid='ignore'):
+        stop_loss_hit = low <= reference * (1 - stop_loss)
+        take_profit_hit = high >= reference * (1 + take_profit)
+    hit = (stop_loss_hit | take_profit_hit) & ~buy & opened
+
+    # hits since the start of the segment, the exit being the first one (buy rows are never hits)
+    hits = np.cumsum(hit)
+    hits_in_segment = hits - np.where(has_buy, hits[np.maximum(last_buy, 0)], 0)
+    exit_row = hit & (hits_in_segment == 1)
+
+    in_position_after = opened & (hits_in_segment == 0)
+    # on a buy row, 'In position' tells whether the position was already open (the buy did not open it)
+    in_position_before = np.r_[in_position, in_position_after[:-1]].astype(bool)
+
+    take_profit_exit = exit_row & ~stop_loss_hit
+    if intrabar is not None:
+        first, last, fine_high, fine_low = intrabar
+        ambiguous = np.flatnonzero(exit_row & stop_loss_hit & take_profit_hit)
+        take_profit_exit[ambiguous] = take_profit_first(first[ambiguous], last[ambiguous], fine_high, fine_low,
+                                                        reference[ambiguous], take_profit, stop_loss)
+
+    columns = {'Buy': buy,
+               'Stop loss': exit_row & ~take_profit_exit,
+               'Take profit': take_profit_exit,
+               'In position': np.where(buy, in_position_before, in_position_after)}
+
+    if len(close):
+        in_position = bool(in_position_after[-1])
+        last_buy_price = float(reference[-1]) if has_buy[-1] else last_buy_price
+    return columns, in_position, last_buy_price
+
+
+def trade_segments(buy, exit_rows, in_market=False):
+    """
+    (entry rows, exit rows) of the trades of the Backtester's rule: a Buy enters when out of the market, the next
+    stop loss / take profit row after the entry exits. The exit row of a trade still open at the end is -1.
+    With in_market, a trade entered before the first row is open: its entry row is -1, and it exits on the first
+    stop loss / take profit row.
+    """
+    entries = np.flatnonzero(buy)
+    exits = np.flatnonzero(exit_rows)
+    trade_entries, trade_exits = [], []
+
+    row = 0  # first row out of the market
+    if in_market:
+        trade_entries.append(-1)
+        if not len(exits):
+            trade_exits.append(-1)
+            return np.array(trade_entries, dtype=np.int64), np.array(trade_exits, dtype=np.int64)
+        trade_exits.append(exits[0])
+        row = exits[0] + 1
+
+    while True:
+        i = np.searchsorted(entries, row)
+        if i == len(entries):
+            break
+        entry = entries[i]
+        j = np.searchsorted(exits, entry, side='right')  # an exit on the entry row itself does not count
+        trade_entries.append(entry)
+        if j == len(exits):
+            trade_exits.append(-1)
+            break
+        trade_exits.append(exits[j])
+        row = exits[j] + 1
+
+    return np.array(trade_entries, dtype=np.int64), np.array(trade_exits, dtype=np.int64)
+
+
+class StreamingEquityCurve:
+    """
+    equity_curve over consecutive blocks of rows: the portfolio value, the trade still open at the end of a block
+    and the drawdown are carried to the next one, so that the blocks performances are those of the whole history.
+    """
+
+    def __init__(self, stop_loss, take_profit, initial_investment=1.0):
+        self.stop_loss = stop_loss
+        self.take_profit = take_profit
+        self.initial_investment = float(initial_investment)
+
+        self.portfolio = self.initial_investment  # value out of the market, after the trades closed so far
+        self.entry_close = None  # Close of the entry of the trade open at the end of the last block
+        self.running_max = -np.inf
+        self.last_performance = None
+        self.max_drawdown = 0.0
+        self.trades = 0
+        self.wins = 0
+
+    def update(self, close, buy, stop_loss_rows, take_profit_rows):
+        """:return: performance array of these rows"""
+        close = np.asarray(close, dtype=np.float64)
+        stop_loss_rows = np.asarray(stop_loss_rows, dtype=bool)
+        take_profit_rows = np.asarray(take_profit_rows, dtype=bool)
+        n = len(close)
+        if n == 0:
+            return np.empty(0)
+
+        entries, exits = trade_segments(np.asarray(buy, dtype=bool), stop_loss_rows | take_profit_rows,
+                                        in_market=self.entry_close is not None)
+        closed_exits = exits[exits >= 0]
+        won = ~stop_loss_rows[closed_exits]
+        factors = np.where(won, 1 + self.take_profit, 1 - self.stop_loss)
+
+        # portfolio value out of the market: multiplied trade after trade, in the same order as the row-by-row loop
+        levels = np.multiply.accumulate(np.r_[self.portfolio, factors])
+        exited = np.zeros(n, dtype=np.int64)
+        exited[closed_exits] = 1
+        portfolio = levels[np.cumsum(exited)]
+
+        in_market = np.zeros(n + 1, dtype=np.int64)
+        np.add.at(in_market, np.maximum(entries, 0), 1)
+        np.add.at(in_market, np.where(exits >= 0, exits, n), -1)
+        in_market = np.cumsum(in_market[:-1]) > 0
+
+        # entry Close of each row, the one of the trade carried from the previous block first
+        entered = np.zeros(n, dtype=bool)
+        entered[entries[entries >= 0]] = True
+        entry_row = np.maximum.accumulate(np.where(entered, np.arange(1, n + 1), 0))
+        entry_close = np.r_[np.nan if self.entry_close is None else self.entry_close, close][entry_row]
+        performance = np.where(in_market, (portfolio * close) / entry_close, portfolio) / self.initial_investment
+
+        self.portfolio = float(levels[-1])
+        self.entry_close = float(entry_close[-1]) if exits[-1:].tolist() == [-1] else None
+        running_max = np.maximum.accumulate(np.r_[self.running_max, performance])[1:]
+        self.running_max = float(running_max[-1])
+        self.max_drawdown = max(self.max_drawdown, float(np.max(1 - performance / running_max)))
+        self.last_performance = float(performance[-1])
+        self.trades += len(closed_exits)
+        self.wins += int(won.sum())
+        return performance
+
+    def stats(self):
+        """final_return, max_drawdown, trades, win_rate of the rows seen so far"""
+        return {'final_return': self.last_performance - 1 if self.last_performance is not None else 0.0,
+                'max_drawdown': self.max_drawdown,
+                'trades': self.trades,
+                'win_rate': self.wins / self.trades if self.trades else float('nan')}
+
+
+def equity_curve(close, buy, stop_loss_rows, take_profit_rows, stop_loss, take_profit, initial_investment=1.0):
+    """
+    Portfolio value relative to the initial investment at every row, as Backtester.add_performance_column
+    computes it: a stop loss exit multiplies it by (1 - stop_loss) (checked first), a take profit one by
+    (1 + take_profit), and while in the market it follows Close relative to the entry Close.
+
+    :return: (performance array, summary stats dict: final_return, max_drawdown, trades, win_rate)
+    """
+    curve = StreamingEquityCurve(stop_loss, take_profit, initial_investment)
+    performance = curve.update(close, buy, stop_loss_rows, take_profit_rows)
+    return performance, curve.stats()
+
+
+def batch_final_performance(close, high, low, buy, take_profits, stop_losses, initial_investment=1.0,
+                            max_cells=50_000_000):
+    """
+    Last value of equity_curve(simulate_oco_exits(...)) for many (take_profit, stop_loss) pairs at once, starting out
+    of position: the pairs share the buy mask and reference prices, their stop loss / take profit hits are evaluated
+    together on a (pair x row) array. Pairs are processed in chunks of at most `max_cells` cells.
+
+    :param take_profits: take profit threshold of each pair
+    :param stop_losses: stop loss threshold of each pair, same length
+    :return: array of the final performance of each pair
+    """
+    close, high, low = (np.asarray(a, dtype=np.float64) for a in (close, high, low))
+    buy = np.asarray(buy, dtype=bool)
+    take_profits = np.asarray(take_profits, dtype=np.float64)
+    stop_losses = np.asarray(stop_losses, dtype=np.float64)
+    n = len(close)
+    if n == 0:
+        return np.ones(len(take_profits))
+
+    # shared by every pair: segments start at each buy, with the buy's Close as reference
+    rows = np.arange(n)
+    last_buy = np.maximum.accumulate(np.where(buy, rows, -1))
+    has_buy = last_buy >= 0
+    segment_start = np.maximum(last_buy, 0)
+    reference = np.where(has_buy, close[segment_start], np.nan)
+    can_exit = has_buy & ~buy
+    buy_rows = np.flatnonzero(buy)
+
+    ret = np.empty(len(take_profits))
+    chunk = max(1, max_cells // n)
+    for first in range(0, len(take_profits), chunk):
+        take_profit = take_profits[first:first + chunk, None]
+        stop_loss = stop_losses[first:first + chunk, None]
+
+        with np.errstate(invalid='ignore'):
+            stop_loss_hit = low <= reference * (1 - stop_loss)
+            hit = (stop_loss_hit | (high >= reference * (1 + take_profit))) & can_exit
+        hits = np.cumsum(hit, axis=1)
+        exit_row = hit & (hits - np.where(has_buy, hits[:, segment_start], 0) == 1)
+        del hits
+
+        # portfolio multiplied exit after exit, as in equity_curve (x * 1.0 leaves the other rows exact)
+        factors = np.where(exit_row, np.where(stop_loss_hit, 1 - stop_loss, 1 + take_profit), 1.0)
+        factors[:, 0] = initial_investment * factors[:, 0]
+        portfolio = np.multiply.accumulate(factors, axis=1)[:, -1]
+
+        # a trade still open at the end was entered at the first buy after the last exit
+        any_exit = exit_row.any(axis=1)
+        last_exit = np.where(any_exit, n - 1 - np.argmax(exit_row[:, ::-1], axis=1), -1)
+        next_buy = np.searchsorted(buy_rows, last_exit, side='right')
+        still_open = next_buy < len(buy_rows)
+        entry = buy_rows[np.minimum(next_buy, len(buy_rows) - 1)] if len(buy_rows) else np.zeros_like(next_buy)
+
+        ret[first:first + chunk] = np.where(still_open, (portfolio * close[-1]) / close[entry],
+                                            portfolio) / initial_investment
+    return ret